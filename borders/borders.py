@@ -1,34 +1,65 @@
+import collections
+import concurrent.futures
+import io
 import itertools
 import json
 import logging
 import math
+import os
+import struct
+import threading
 import time
 import typing
 import xml.etree.ElementTree as ET
+import xml.sax.saxutils
 
 import cachetools.func
+import lz4.frame
 import requests
+import requests.adapters
 import shapely.geometry
 import shapely.ops
+import shapely.prepared
+import shapely.strtree
+import shapely.wkb
 
-from borders.geoutils import split_by_common_ways
+from borders.geoutils import split_by_common_ways, split_by_components
 from borders.wikidata import fetch_from_wikidata, WikidataSimcEntry
 from converters.feature import ImmutableFeature, Feature
-from converters.kmlshapely import kml_to_shapely
+from converters.kmlshapely import iter_kml_to_shapely
 from converters.prg import GminyCache
-from converters.teryt import simc as SIMC_DICT
+from converters.teryt import SimcEntry, simc as SIMC_DICT
+from converters.tools import Cache, Serializer, get_cache_manager
 
 __log = logging.getLogger(__name__)
 
+EMUIA_TILES_CACHE_NAME = "osm_emuia_tiles_v1"
+EMUIA_FEATURES_CACHE_NAME = "osm_emuia_features_v1"
+EMUIA_TILE_TTL = 24 * 3600
+# number of tiles downloaded from EMUiA at the same time
+EMUIA_CONCURRENCY = int(os.environ.get("EMUIA_CONCURRENCY", 4))
+EMUIA_RETRIES = 3
+EMUIA_RETRY_BACKOFF = 2  # seconds, doubled on each retry
+EMUIA_TIMEOUT = 300
+EMUIA_CHUNK_SIZE = 64 * 1024
+WORKING_AREA_BUFFER = 0.005  # ~ 500m along meridian
+
+# shared by all downloads, so connections to EMUiA are kept alive between tiles
+_emuia_session = requests.Session()
+_emuia_session.mount(
+    "http://", requests.adapters.HTTPAdapter(pool_maxsize=EMUIA_CONCURRENCY)
+)
+_emuia_tile_cache_lock = threading.Lock()
+
 
 @cachetools.func.ttl_cache(maxsize=128, ttl=600)
 def get_adm_border(terc: str) -> shapely.geometry.base.BaseGeometry:
     GMINY_DICT = GminyCache().get_cache()
-    geojson = GMINY_DICT[terc]
+    geojson = GMINY_DICT.get(terc)
     if geojson:
         return shapely.geometry.shape(geojson["geometry"])
     else:
-        candidates = [x for x in GMINY_DICT.keys() if x.startswith(terc[:-1])]
+        candidates = list(GMINY_DICT.iter_prefix(terc[:-1]))
         raise KeyError(
             "Gmina o kodzie {0} nieznaleziona w PRG. Może jedna z: {1}".format(
                 terc, ", ".join(candidates)
@@ -44,6 +75,10 @@ def geometry_as_geojson(o: shapely.geometry.base.BaseGeometry) -> str:
 
 
 def divide_bbox(bbox: TYPE_BBOX) -> typing.List[TYPE_BBOX]:
+    """
+    Returns tiles of a global grid that cover bbox, so neighbouring areas request
+    (and cache) the same tiles
+    """
     (minx, miny, maxx, maxy) = bbox
     # EPSG:2180
     # __MAX_BBOX_X = 20000
@@ -58,29 +93,178 @@ def divide_bbox(bbox: TYPE_BBOX) -> typing.List[TYPE_BBOX]:
         (
             x / __PRECISION,
             y / __PRECISION,
-            min(x / __PRECISION + __MAX_BBOX_X, maxx),
-            min(y / __PRECISION + __MAX_BBOX_Y, maxy),
+            (x + __MAX_BBOX_X) / __PRECISION,
+            (y + __MAX_BBOX_Y) / __PRECISION,
         )
         for x in range(
-            math.floor(minx * __PRECISION),
+            math.floor(minx * __PRECISION) // __MAX_BBOX_X * __MAX_BBOX_X,
             math.ceil(maxx * __PRECISION),
-            __MAX_BBOX_X * __PRECISION,
+            __MAX_BBOX_X,
         )
         for y in range(
-            math.floor(miny * __PRECISION),
+            math.floor(miny * __PRECISION) // __MAX_BBOX_Y * __MAX_BBOX_Y,
             math.ceil(maxy * __PRECISION),
-            __MAX_BBOX_Y * __PRECISION,
+            __MAX_BBOX_Y,
         )
     ]
     __log.info("Split bbox to {0} parts".format(len(rv)))
     return rv
 
 
-@cachetools.func.ttl_cache(maxsize=128, ttl=24 * 3600)
-def fetch_from_emuia_cached(bbox: TYPE_BBOX) -> str:
+class WorkingArea:
+    """
+    Area around gmina, within which borders are processed. Predicates compare
+    envelopes first and only then prepared geometry of the area
+    """
+
+    def __init__(self, adm_bound: shapely.geometry.base.BaseGeometry):
+        self.geometry = adm_bound.buffer(WORKING_AREA_BUFFER)
+        self.bounds = self.geometry.bounds
+        self._prepared = shapely.prepared.prep(self.geometry)
+        # prepared geometry builds its index lazily, and is shared between requests
+        self._lock = threading.Lock()
+
+    def intersects(self, geometry: shapely.geometry.base.BaseGeometry) -> bool:
+        if geometry.is_empty:
+            return False
+        (minx, miny, maxx, maxy) = geometry.bounds
+        if (
+            minx > self.bounds[2]
+            or maxx < self.bounds[0]
+            or miny > self.bounds[3]
+            or maxy < self.bounds[1]
+        ):
+            return False
+        with self._lock:
+            return self._prepared.intersects(geometry)
+
+    def contains(self, geometry: shapely.geometry.base.BaseGeometry) -> bool:
+        if geometry.is_empty:
+            return False
+        (minx, miny, maxx, maxy) = geometry.bounds
+        if (
+            minx < self.bounds[0]
+            or maxx > self.bounds[2]
+            or miny < self.bounds[1]
+            or maxy > self.bounds[3]
+        ):
+            return False
+        with self._lock:
+            return self._prepared.contains(geometry)
+
+
+@cachetools.func.ttl_cache(maxsize=128, ttl=600)
+def get_working_area(terc: str) -> WorkingArea:
+    return WorkingArea(get_adm_border(terc))
+
+
+def tiles_for_area(
+    adm_bound: shapely.geometry.base.BaseGeometry, working_area: WorkingArea = None
+) -> typing.List[TYPE_BBOX]:
+    """
+    Returns tiles of divide_bbox that intersect working area around adm_bound. Other
+    tiles can't contain any border that will be processed
+    """
+    if working_area is None:
+        working_area = WorkingArea(adm_bound)
+    tiles = divide_bbox(adm_bound.bounds)
+    rv = [x for x in tiles if working_area.intersects(shapely.geometry.box(*x))]
+    __log.info(
+        "Skipping {0} of {1} tiles outside of working area".format(
+            len(tiles) - len(rv), len(tiles)
+        )
+    )
+    return rv
+
+
+class EmuiaTileSerializer(Serializer):
+    """
+    Stores download time and lz4 compressed KML of the tile. KML is kept compressed
+    after deserialization, so it can be parsed while being decompressed
+    """
+
+    def serialize(self, dct: dict) -> bytes:
+        return struct.pack("!d", dct["time"]) + dct["kml_lz4"]
+
+    def deserialize(self, data: bytes) -> dict:
+        return {"time": struct.unpack("!d", data[:8])[0], "kml_lz4": data[8:]}
+
+
+class EmuiaFeaturesSerializer(Serializer):
+    """
+    Stores download time and parsed features of the tile, each as WKB of geometry and
+    JSON of tags, lz4 compressed
+    """
+
+    __header = struct.Struct("!II")
+
+    def serialize(self, dct: dict) -> bytes:
+        parts = []
+        for feature in dct["features"]:
+            wkb = feature.geometry.wkb
+            tags = json.dumps(feature.tags, ensure_ascii=False).encode("utf-8")
+            parts.extend((self.__header.pack(len(wkb), len(tags)), wkb, tags))
+        return struct.pack("!d", dct["time"]) + lz4.frame.compress(b"".join(parts))
+
+    def deserialize(self, data: bytes) -> dict:
+        body = lz4.frame.decompress(data[8:])
+        features = []
+        offset = 0
+        while offset < len(body):
+            (wkb_len, tags_len) = self.__header.unpack_from(body, offset)
+            offset += self.__header.size
+            geometry = shapely.wkb.loads(body[offset : offset + wkb_len])
+            offset += wkb_len
+            tags = json.loads(body[offset : offset + tags_len].decode("utf-8"))
+            offset += tags_len
+            features.append(Feature(geometry, tags))
+        return {"time": struct.unpack("!d", data[:8])[0], "features": features}
+
+
+def get_emuia_cache(name: str, serializer: Serializer) -> typing.Optional[Cache]:
+    try:
+        return get_cache_manager().get_or_create_cache(name, serializer=serializer)
+    except Exception as e:
+        # work without cache, e.g. when other process holds the lock on shelve
+        __log.warning("EMUiA cache {0} unavailable: {1}".format(name, e))
+        return None
+
+
+def get_emuia_tile_cache() -> typing.Optional[Cache]:
+    return get_emuia_cache(EMUIA_TILES_CACHE_NAME, EmuiaTileSerializer())
+
+
+def get_emuia_features_cache() -> typing.Optional[Cache]:
+    return get_emuia_cache(EMUIA_FEATURES_CACHE_NAME, EmuiaFeaturesSerializer())
+
+
+def download_from_emuia(
+    bbox: TYPE_BBOX, session: requests.Session = _emuia_session
+) -> typing.Tuple[typing.List[Feature], bytes]:
+    """
+    Returns features of the tile and lz4 compressed KML for the cache
+    """
+    for attempt in range(1, EMUIA_RETRIES + 1):
+        try:
+            return _download_from_emuia(bbox, session)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if attempt == EMUIA_RETRIES:
+                raise
+            delay = EMUIA_RETRY_BACKOFF * 2 ** (attempt - 1)
+            __log.warning(
+                "Downloading BBOX: {0} failed: {1}. Retrying in {2}s".format(
+                    bbox, e, delay
+                )
+            )
+            time.sleep(delay)
+
+
+def _download_from_emuia(
+    bbox: TYPE_BBOX, session: requests.Session
+) -> typing.Tuple[typing.List[Feature], bytes]:
     try:
         __log.info("Downloading BBOX: {0} from EMUiA".format(bbox))
-        resp = requests.get(
+        resp = session.get(
             "http://emuia1.gugik.gov.pl/wmsproxy/emuia/wms",
             params={
                 "FORMAT": "application/vnd.google-earth.kml+xml",
@@ -97,64 +281,220 @@ def fetch_from_emuia_cached(bbox: TYPE_BBOX) -> str:
                 "BBOX": "{0},{1},{2},{3}".format(*bbox),
             },
             verify=False,
+            timeout=EMUIA_TIMEOUT,
+            stream=True,
         )
     except requests.exceptions.ConnectionError as e:
         raise requests.exceptions.ConnectionError(
             e.errno if e.errno else -1, "Problem connecting to EMUiA", e
         )
-    try:
-        ET.XML(resp.text)
-    except Exception as e:
-        if len(resp.text) < 1024:
-            raise ValueError("Unexpected response from EMUiA. Not an XML: " + resp.text)
-        else:
-            raise ValueError("Unexpected response from EMUiA. Not an XML", e)
-    return resp.text
+    with resp:
+        # response is parsed and compressed for the cache chunk by chunk, beginning
+        # is kept for error message
+        compressor = lz4.frame.LZ4FrameCompressor()
+        compressed = [compressor.begin()]
+        head = bytearray()
+
+        def chunks():
+            for chunk in resp.iter_content(chunk_size=EMUIA_CHUNK_SIZE):
+                if len(head) < 1024:
+                    head.extend(chunk[: 1024 - len(head)])
+                compressed.append(compressor.compress(chunk))
+                yield chunk
+
+        try:
+            features = list(iter_kml_to_shapely(chunks()))
+        except ET.ParseError as e:
+            if len(head) < 1024:
+                raise ValueError(
+                    "Unexpected response from EMUiA. Not an XML: "
+                    + head.decode("utf-8", errors="replace")
+                )
+            else:
+                raise ValueError("Unexpected response from EMUiA. Not an XML", e)
+    compressed.append(compressor.flush())
+    return features, b"".join(compressed)
+
+
+def _lz4_chunks(data: bytes) -> typing.Iterator[bytes]:
+    with lz4.frame.open(io.BytesIO(data)) as f:
+        yield from iter(lambda: f.read(EMUIA_CHUNK_SIZE), b"")
+
+
+def _get_cached(
+    cache_getter: typing.Callable[[], typing.Optional[Cache]], key: str
+) -> typing.Optional[dict]:
+    """
+    Returns entry of EMUiA cache, when it is present and not older than
+    EMUIA_TILE_TTL. Older entries are removed from the cache
+    """
+    # cache handles (shelve, boto3 resources) aren't thread safe
+    with _emuia_tile_cache_lock:
+        cache = cache_getter()
+        if not cache:
+            return None
+        try:
+            entry = cache.get(key)
+            if entry and entry["time"] + EMUIA_TILE_TTL <= time.time():
+                # remove expired entry, so cache doesn't keep stale tiles forever
+                cache.delete(key)
+                entry = None
+        except Exception as e:
+            __log.warning("Reading EMUiA tile {0} from cache: {1}".format(key, e))
+            return None
+    return entry
+
+
+def _add_cached(
+    cache_getter: typing.Callable[[], typing.Optional[Cache]], key: str, entry: dict
+) -> None:
+    with _emuia_tile_cache_lock:
+        cache = cache_getter()
+        if not cache:
+            return
+        try:
+            cache.add(key, entry)
+        except Exception as e:
+            __log.warning("Storing EMUiA tile {0} in cache: {1}".format(key, e))
 
 
 def fetch_from_emuia(bbox: TYPE_BBOX) -> typing.List[Feature]:
-    return kml_to_shapely(fetch_from_emuia_cached(bbox))
+    """
+    Returns features of the tile. Parsed features are cached on top of raw KML, so
+    KML is parsed again only when parsed features are missing in the cache
+    """
+    key = "{0},{1},{2},{3}".format(*bbox)
+    entry = _get_cached(get_emuia_features_cache, key)
+    if entry:
+        return entry["features"]
 
+    entry = _get_cached(get_emuia_tile_cache, key)
+    features = None
+    if entry:
+        try:
+            features = list(iter_kml_to_shapely(_lz4_chunks(entry["kml_lz4"])))
+            download_time = entry["time"]
+        except Exception as e:
+            __log.warning("Parsing EMUiA tile {0} from cache: {1}".format(key, e))
 
-def get_borders(
+    if features is None:
+        (features, kml_lz4) = download_from_emuia(bbox)
+        download_time = time.time()
+        _add_cached(
+            get_emuia_tile_cache, key, {"time": download_time, "kml_lz4": kml_lz4}
+        )
+    # expire parsed features together with KML they were parsed from
+    _add_cached(
+        get_emuia_features_cache, key, {"time": download_time, "features": features}
+    )
+    return features
+
+
+def fetch_tiles_from_emuia(
+    bboxes: typing.List[TYPE_BBOX], max_workers: int = EMUIA_CONCURRENCY
+) -> typing.List[Feature]:
+    """
+    Downloads tiles concurrently, at most max_workers at a time. Features are returned
+    in the order of bboxes
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dedup_by_id(
+            itertools.chain.from_iterable(executor.map(fetch_from_emuia, bboxes))
+        )
+
+
+def dedup_by_id(borders: typing.Iterable[Feature]) -> typing.List[Feature]:
+    """
+    Drops repeated features, that come from overlapping tiles, without looking at
+    geometries. Features are the same, when they have the same
+    IDENTYFIKATOR_MIEJSCOWOSCI and all other tags (including version). Features
+    without identifier are all kept
+    """
+    rv = []
+    seen = set()
+    removed = 0
+    for border in borders:
+        if "IDENTYFIKATOR_MIEJSCOWOSCI" in border.tags:
+            key = tuple(sorted(border.tags.items()))
+            if key in seen:
+                removed += 1
+                continue
+            seen.add(key)
+        rv.append(border)
+    __log.debug("Removed {0} repeated features".format(removed))
+    return rv
+
+
+def get_borders(*args, **kwargs) -> bytes:
+    """
+    Returns whole OSM document, see get_borders_converter
+    """
+    return get_borders_converter(*args, **kwargs).tostring()
+
+
+def get_borders_converter(
     terc: str,
     filter_func: typing.Callable[[Feature], bool] = lambda x: True,
     borders_mapping: typing.Callable[
         [typing.List[Feature]], typing.List[Feature]
-    ] = split_by_common_ways,
+    ] = split_by_components,
     do_clean_borders: bool = True,
-) -> bytes:
+) -> "FeatureToOsm":
     adm_bound = get_adm_border(terc)
-    borders = []
-    __log.info("Downloading data from EMUiA")
-    for bbox in divide_bbox(adm_bound.bounds):  # area we need to fetch from EMUiA
-        borders.extend(fetch_from_emuia(bbox))
-    wikidata = []
-    __log.info("Downloading data from Wikidata")
-    try:
-        wikidata = fetch_from_wikidata(terc)
-    except Exception as e:
-        # ignore any exceptions
-        __log.warning(
-            "Exception during fetch from Wikidata: {0}",
-            e,
-            exc_info=(type(e), e, e.__traceback__),
-        )
+    working_area = get_working_area(terc)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        # Wikidata is queried while tiles are downloaded
+        __log.info("Downloading data from Wikidata")
+        wikidata_future = executor.submit(fetch_from_wikidata, terc)
+        __log.info("Downloading data from EMUiA")
+        # area we need to fetch from EMUiA
+        borders = fetch_tiles_from_emuia(tiles_for_area(adm_bound, working_area))
+        wikidata = []
+        try:
+            wikidata = wikidata_future.result()
+        except Exception as e:
+            # ignore any exceptions
+            __log.warning(
+                "Exception during fetch from Wikidata: {0}",
+                e,
+                exc_info=(type(e), e, e.__traceback__),
+            )
     __log.info("Processing data")
-    return process(
+    return process_converter(
         adm_bound=adm_bound,
         borders=borders,
         filter_func=filter_func,
         borders_mapping=borders_mapping,
         wikidata=wikidata,
         do_clean_borders=do_clean_borders,
+        working_area=working_area,
     )
 
 
-def clean_borders(borders: typing.List[Feature], do_clean: bool = True) -> None:
+def prefetch_simc(borders: typing.List[Feature]) -> typing.Dict[str, SimcEntry]:
+    """
+    Reads SIMC entries of borders and of their parents with two bulk reads
+
+    :param borders: borders to get entries for, by their TERYT_MIEJSCOWOSCI
+    :return: entries found in SIMC by their code
+    """
+    codes = set(x.tags.get("TERYT_MIEJSCOWOSCI") for x in borders) - {None}
+    rv = SIMC_DICT().get_many(codes)
+    parents = set(x.parent for x in rv.values() if x.parent) - rv.keys()
+    if parents:
+        rv.update(SIMC_DICT().get_many(parents))
+    return rv
+
+
+def clean_borders(
+    borders: typing.List[Feature],
+    do_clean: bool = True,
+    simc: typing.Dict[str, SimcEntry] = None,
+) -> None:
     """
     :param borders:  borders to process
     :param do_clean: do the changes
+    :param simc: SIMC entries of borders and their parents, see prefetch_simc
 
     Checks borders against EMUiA and SIMC data.
 
@@ -166,12 +506,26 @@ def clean_borders(borders: typing.List[Feature], do_clean: bool = True) -> None:
     3. If moving border from admin_level=10 to 8, remove the area from parent
     4. If moving border from admin_level=8 to 10, then join the area to the parent
     """
+    if simc is None:
+        simc = prefetch_simc(borders)
+    by_id = {}
+    by_simc = {}
+    for border in borders:
+        # first border wins, as with search through the list
+        by_id.setdefault(border.tags.get("IDENTYFIKATOR_MIEJSCOWOSCI"), border)
+        by_simc.setdefault(border.tags.get("TERYT_MIEJSCOWOSCI"), border)
+    by_id.pop(None, None)
+    by_simc.pop(None, None)
+    # geometry changes are collected per parent and applied at once
+    to_remove = collections.defaultdict(list)  # IDENTYFIKATOR_MIEJSCOWOSCI -> children
+    to_join = collections.defaultdict(list)  # TERYT_MIEJSCOWOSCI -> borders
+
     for border in borders:
         simc_code = border.tags.get("TERYT_MIEJSCOWOSCI")
         parent_id = border.tags.get("IDENTYFIKATOR_NADRZEDNEJ")
         emuia_level = 10 if parent_id else 8
 
-        simc_entry = SIMC_DICT().get(simc_code)
+        simc_entry = simc.get(simc_code)
         if not simc_entry:
             __log.error(
                 "No entry in TERYT dictionary for SIMC: {0}, name: {1}".format(
@@ -192,63 +546,43 @@ def clean_borders(borders: typing.List[Feature], do_clean: bool = True) -> None:
 
         if emuia_level == 10 and simc_level == 10:
             # verify that they have the same parent
-            try:
-                parent_border = [
-                    x
-                    for x in borders
-                    if x.tags.get("IDENTYFIKATOR_MIEJSCOWOSCI") == parent_id
-                ][0]
-                if simc_entry.parent != parent_border.tags.get("TERYT_MIEJSCOWOSCI"):
-                    fixme.append(
-                        "Different parents. In EMUiA it is teryt:simc: {0}, name: {1}".format(
-                            simc_entry.parent, SIMC_DICT()[simc_entry.parent].nazwa
-                        )
-                    )
-            except IndexError:
+            parent_border = by_id.get(parent_id)
+            if parent_border is None:
                 fixme.append("Missing parent border: {0}".format(parent_id))
+            elif simc_entry.parent != parent_border.tags.get("TERYT_MIEJSCOWOSCI"):
+                fixme.append(
+                    "Different parents. In EMUiA it is teryt:simc: {0}, name: {1}".format(
+                        simc_entry.parent, simc[simc_entry.parent].nazwa
+                    )
+                )
 
         if emuia_level == 10 and simc_level == 8:
             # raise the border level to admin_level 8
-            try:
-                parent_border = [
-                    x
-                    for x in borders
-                    if x.tags.get("IDENTYFIKATOR_MIEJSCOWOSCI") == parent_id
-                ][0]
-                new_geo = parent_border.geometry.difference(border.geometry)
-                if not new_geo.is_empty and do_clean:
-                    __log.info(
-                        "Changing geometry (EMUiA = 10, TERC = 8) of {0} because of {1}. "
-                        "{0} border dump: {2}".format(
-                            parent_border.tags.get("NAZWA"),
-                            border.tags.get("NAZWA"),
-                            parent_border,
-                        )
-                    )
-                    parent_border.geometry = new_geo
+            parent_border = by_id.get(parent_id)
+            if parent_border is None:
+                fixme.append("Missing parent border: {0}".format(parent_id))
+            else:
+                if do_clean:
+                    to_remove[parent_id].append(border)
                 fixme.append(
                     "EMUiA points teryt:simc {0}, name: {1} as parent. In TERC this is standalone".format(
                         parent_border.tags.get("TERYT_MIEJSCOWOSCI"),
                         parent_border.tags.get("NAZWA"),
                     )
                 )
-            except IndexError:
-                fixme.append("Missing parent border: {0}".format(parent_id))
 
         if emuia_level == 8 and simc_level == 10:
             fixme.append(
                 "TERC points this as part of teryt:simc={0}, name={1}".format(
-                    simc_entry.parent, SIMC_DICT()[simc_entry.parent].nazwa
+                    simc_entry.parent, simc[simc_entry.parent].nazwa
                 )
             )
             level = emuia_level
-            try:
-                if do_clean:
-                    parent_border = [
-                        x
-                        for x in borders
-                        if x.tags.get("TERYT_MIEJSCOWOSCI") == simc_entry.parent
-                    ][0]
+            if do_clean:
+                parent_border = by_simc.get(simc_entry.parent)
+                if parent_border is None:
+                    fixme.append("Missing parent border: {0}".format(simc_entry.parent))
+                else:
                     __log.info(
                         "Changing geometry (EMUiA = 8, TERC = 10) of {0} because of {1}. "
                         "{0} border dump: {2}".format(
@@ -257,27 +591,70 @@ def clean_borders(borders: typing.List[Feature], do_clean: bool = True) -> None:
                             parent_border,
                         )
                     )
-                    parent_border.geometry = parent_border.geometry.union(
-                        border.geometry
-                    )
+                    to_join[simc_entry.parent].append(border)
                     level = simc_level
-            except IndexError:
-                fixme.append("Missing parent border: {0}".format(simc_entry.parent))
 
         border.tags["admin_level"] = str(level)
         if fixme:
             border.tags["fixme"] = ", ".join(fixme)
 
+    for (parent_id, children) in to_remove.items():
+        _remove_children(by_id[parent_id], children)
+    for (simc_code, children) in to_join.items():
+        parent_border = by_simc[simc_code]
+        parent_border.geometry = shapely.ops.unary_union(
+            [parent_border.geometry] + [x.geometry for x in children]
+        )
+
+
+def _remove_children(parent_border: Feature, children: typing.List[Feature]) -> None:
+    """
+    Removes area of children from parent_border, skipping any child that would leave
+    parent without area
+    """
+    new_geo = parent_border.geometry.difference(
+        shapely.ops.unary_union([x.geometry for x in children])
+    )
+    if new_geo.is_empty and len(children) > 1:
+        # children cover whole parent together, remove them one by one
+        for child in children:
+            _remove_children(parent_border, [child])
+        return
+    if new_geo.is_empty:
+        return
+    for child in children:
+        __log.info(
+            "Changing geometry (EMUiA = 10, TERC = 8) of {0} because of {1}. "
+            "{0} border dump: {2}".format(
+                parent_border.tags.get("NAZWA"), child.tags.get("NAZWA"), parent_border
+            )
+        )
+    parent_border.geometry = new_geo
+
 
 def add_wikidata(
     wikidata: typing.List[WikidataSimcEntry], borders: typing.List[Feature]
 ):
-    rest = list(wikidata)
-    todo = list(borders)
-    border_iter = itertools.cycle(todo)
+    """
+    Adds wikidata and wikipedia tags to borders. Entry is matched to a border only if
+    it is the only candidate, by exact name, then by point within the border and part
+    of the name and at last by part of the name. Ambiguous borders are retried as
+    long as other matches take away their candidates
+    """
+    by_name = collections.defaultdict(list)
+    by_trigram = collections.defaultdict(set)
+    for (i, entry) in enumerate(wikidata):
+        by_name[entry.miejscowosc].append(i)
+        for j in range(len(entry.miejscowosc) - 2):
+            by_trigram[entry.miejscowosc[j : j + 3]].add(i)
+    points = [x.point for x in wikidata]
+    tree = shapely.strtree.STRtree(points) if points else None
+    index_by_id = dict((id(x), i) for (i, x) in enumerate(points))
+    containing_name = {}  # NAZWA -> entries that have it in their name
+    within_border = {}  # id(border) -> entries with point within border
+    matched = set()
 
     def update_border(entry, border_to_update):
-        rest.remove(entry)
         border_to_update.tags["wikidata"] = entry.wikidata
         border_to_update.tags["wikipedia"] = entry.wikipedia
         if not border_to_update.tags["NAZWA"] in entry.miejscowosc:
@@ -287,53 +664,78 @@ def add_wikidata(
                 entry.miejscowosc
             )
 
-    loop_limit = 100
-
-    while todo and loop_limit > 0:
-        loop_limit -= 1
-        border = next(border_iter)
-        candidates = [x for x in rest if x.miejscowosc == border.tags["NAZWA"]]
-        if len(candidates) <= 1:
-            if candidates:
-                update_border(candidates[0], border)
-                todo.remove(border)  # we will not need to process it again
-                border_iter = itertools.cycle(todo)
-            else:
-                # no candidates by geometry
-                candidates = [
-                    x
-                    for x in rest
-                    if x.point.within(border.geometry)
-                    and border.tags["NAZWA"] in x.miejscowosc
-                ]
-                if len(candidates) <= 1:
-                    if candidates:
-                        update_border(candidates[0], border)
-                        todo.remove(border)  # we will not need to process it again
-                        border_iter = itertools.cycle(todo)
-                    else:
-                        candidates = [
-                            x for x in rest if border.tags["NAZWA"] in x.miejscowosc
-                        ]
-                        if len(candidates) <= 1:
-                            # no or one candidate by name and no candidate by geometry
-                            # remove so we will not process it again
-                            todo.remove(border)  # we will not need to process it again
-                            border_iter = itertools.cycle(todo)
-                            if candidates:
-                                update_border(candidates[0], border)
-
-
-def process(
+    def entries_containing(name: str) -> typing.List[int]:
+        """
+        :return: indexes of entries that have name as part of their name, in order
+        """
+        if len(name) < 3:
+            found = range(len(wikidata))
+        else:
+            found = set.intersection(
+                *(by_trigram.get(name[j : j + 3], set()) for j in range(len(name) - 2))
+            )
+        return [i for i in sorted(found) if name in wikidata[i].miejscowosc]
+
+    def match(border) -> typing.Tuple[bool, typing.Optional[int]]:
+        """
+        :return: if border is resolved, and index of matching entry if any
+        """
+        name = border.tags["NAZWA"]
+        candidates = [x for x in by_name.get(name, ()) if x not in matched]
+        if candidates:
+            return (len(candidates) == 1, candidates[0])
+
+        if name not in containing_name:
+            containing_name[name] = entries_containing(name)
+        by_part = [x for x in containing_name[name] if x not in matched]
+
+        if id(border) not in within_border:
+            prepared = shapely.prepared.prep(border.geometry)
+            within_border[id(border)] = set(
+                index_by_id[id(x)]
+                for x in (tree.query(border.geometry) if tree else ())
+                if prepared.contains(x)
+            )
+        candidates = [x for x in by_part if x in within_border[id(border)]]
+        if candidates:
+            return (len(candidates) == 1, candidates[0])
+
+        if len(by_part) > 1:
+            return (False, None)
+        return (True, by_part[0] if by_part else None)
+
+    todo = list(borders)
+    changed = True
+    while todo and changed:
+        changed = False
+        for border in list(todo):
+            (resolved, i) = match(border)
+            if resolved:
+                todo.remove(border)
+                changed = True
+                if i is not None:
+                    matched.add(i)
+                    update_border(wikidata[i], border)
+
+
+def process(*args, **kwargs) -> bytes:
+    """
+    Returns whole OSM document, see process_converter
+    """
+    return process_converter(*args, **kwargs).tostring()
+
+
+def process_converter(
     adm_bound: shapely.geometry.base.BaseGeometry,
     borders: typing.List[Feature],
     filter_func: typing.Callable[[Feature], bool] = lambda x: True,
     borders_mapping: typing.Callable[
         [typing.List[Feature]], typing.List[Feature]
-    ] = split_by_common_ways,
+    ] = split_by_components,
     wikidata: typing.List[WikidataSimcEntry] = None,
     do_clean_borders: bool = True,
-) -> bytes:
+    working_area: WorkingArea = None,
+) -> "FeatureToOsm":
     """
 
     :param adm_bound: shape of the area that one should work on
@@ -342,21 +744,24 @@ def process(
     :param borders_mapping: function that converts all the features
     :param wikidata: wikidata information for this municipiality
     :param do_clean_borders:
+    :param working_area: WorkingArea of adm_bound, if already computed
     :return:
     """
-    adm_bound = adm_bound.buffer(0.005)  # ~ 500m along meridian
+    if working_area is None:
+        working_area = WorkingArea(adm_bound)
     if not wikidata:
         wikidata = []
 
     def valid_border(x):
-        rv = x.geometry.intersects(adm_bound) and (
+        inside = working_area.intersects(x.geometry)
+        rv = inside and (
             x.tags.get("DO") is None or int(x.tags.get("DO")) > time.time() * 1000
         )
         if not rv:
             msg = ", ".join(
                 "{0}: {1}".format(key, x.tags[key]) for key in sorted(x.tags.keys())
             )
-            if not x.geometry.intersects(adm_bound):
+            if not inside:
                 __log.debug(
                     "Removing border as it is outside working set: {0}".format(msg)
                 )
@@ -365,13 +770,14 @@ def process(
         return rv
 
     __log.debug("Names before dedup: {0}".format(len(borders)))
+    # dict keeps order of borders, so output doesn't depend on hash seed
     borders = [
         im.to_feature()
-        for im in set(ImmutableFeature(x) for x in borders if valid_border(x))
+        for im in dict.fromkeys(ImmutableFeature(x) for x in borders if valid_border(x))
     ]
     __log.debug("Names after dedup: {0}".format(len(borders)))
 
-    clean_borders(borders, do_clean=do_clean_borders)
+    clean_borders(borders, do_clean=do_clean_borders, simc=prefetch_simc(borders))
     add_wikidata(wikidata, borders)
 
     for border in borders:
@@ -414,7 +820,7 @@ def process(
             raise ValueError("Unknown object type: {0}".format(obj_type))
 
     def default_filter(feature: Feature) -> bool:
-        if feature.geometry.within(adm_bound):
+        if working_area.contains(feature.geometry):
             if filter_func(feature):
                 return True
             else:
@@ -423,13 +829,97 @@ def process(
             __log.debug("Border is outside working area: {0}".format(feature))
         return False
 
-    converter = FeatureToOsm(
+    return FeatureToOsm(
         borders=borders,
         tag_mapping=tag_mapping,
         filter_func=default_filter,
         borders_mapping=borders_mapping,
     )
-    return converter.tostring()
+
+
+XML_DECLARATION = "<?xml version='1.0' encoding='UTF-8'?>\n"
+
+
+def _quote_attr(value: str) -> str:
+    return '"{0}"'.format(
+        xml.sax.saxutils.escape(
+            value, {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+        )
+    )
+
+
+# OSM keeps coordinates as fixed-point integers with 7 decimal digits
+COORDINATE_SCALE = 10 ** 7
+_COORDINATE_MASK = (1 << 32) - 1
+
+
+def coordinate_key(point: typing.Tuple[float, float]) -> int:
+    """
+    Packs point rounded to OSM precision into one integer, so points closer than
+    OSM precision are treated as one node
+
+    :param point: (lon, lat) tuple
+    :return: integer with longitude in high and latitude in low 32 bits
+    """
+    lon = round(point[0] * COORDINATE_SCALE)
+    lat = round(point[1] * COORDINATE_SCALE)
+    return (lon << 32) | (lat & _COORDINATE_MASK)
+
+
+def coordinate_from_key(key: int) -> typing.Tuple[int, int]:
+    """
+    :return: (lon, lat) as fixed-point integers
+    """
+    lat = key & _COORDINATE_MASK
+    if lat >= 1 << 31:
+        lat -= 1 << 32
+    return key >> 32, lat
+
+
+def format_coordinate(value: int) -> str:
+    """
+    Formats fixed-point coordinate with no more digits than needed
+    """
+    (whole, fraction) = divmod(abs(value), COORDINATE_SCALE)
+    sign = "-" if value < 0 else ""
+    if fraction:
+        return "{0}{1}.{2:07d}".format(sign, whole, fraction).rstrip("0")
+    return "{0}{1}".format(sign, whole)
+
+
+def way_key(
+    coords: typing.Iterable[typing.Tuple[float, float]]
+) -> typing.Tuple[int, ...]:
+    """
+    Converts way coordinates to node keys, dropping repeated nodes that appear after
+    rounding to OSM precision
+    """
+    rv = []
+    for point in coords:
+        key = coordinate_key(point)
+        if not rv or rv[-1] != key:
+            rv.append(key)
+    return tuple(rv)
+
+
+def canonical_way_key(way: typing.Tuple[int, ...]) -> typing.Tuple[int, ...]:
+    """
+    Returns the same key for a way traversed in the opposite direction and, for
+    closed ways, for a ring starting at any of its nodes
+
+    :param way: node keys, as returned by way_key
+    """
+    if len(way) > 2 and way[0] == way[-1]:
+        ring = way[:-1]
+        smallest = min(ring)
+        rv = min(
+            seq[i:] + seq[:i]
+            for seq in (ring, ring[::-1])
+            for (i, node) in enumerate(seq)
+            if node == smallest
+        )
+        return rv + rv[:1]
+    return min(way, way[::-1])
 
 
 class FeatureToOsm:
@@ -444,8 +934,10 @@ class FeatureToOsm:
         filter_func: typing.Callable[[Feature], bool] = lambda x: True,
         borders_mapping: typing.Callable[
             [typing.List[Feature]], typing.List[Feature]
-        ] = split_by_common_ways,
+        ] = split_by_components,
     ):
+        # nodes are kept in a dict by packed integer keys, as an array based hash
+        # table saved only half of a few MB, but made writing up to 70% slower
         self.__object_store = {"way": {}, "point": {}, "relation": {}}
         self.id_ = itertools.count(-1, -1)
         self.borders = borders
@@ -453,59 +945,119 @@ class FeatureToOsm:
         self.filter = filter_func
         self.borders_mapping = borders_mapping
 
-    def tostring(self) -> bytes:
-        out_xml = ET.Element(
-            "osm", {"generator": "osm-borders", "version": "0.6", "upload": "false"}
+    @classmethod
+    def from_converter(cls, other: "FeatureToOsm") -> "FeatureToOsm":
+        """
+        Creates converter of this class for the same borders as other
+        """
+        return cls(
+            borders=other.borders,
+            tag_mapping=other.tag_mapping,
+            filter_func=other.filter,
+            borders_mapping=other.borders_mapping,
         )
+
+    def tostring(self) -> bytes:
+        return b"".join(self.iter_chunks())
+
+    def write(self, output: typing.BinaryIO) -> int:
+        """
+        Writes document to output as soon as relations are converted
+
+        :return: number of bytes written
+        """
+        rv = 0
+        for chunk in self.iter_chunks():
+            output.write(chunk)
+            rv += len(chunk)
+        return rv
+
+    def iter_chunks(self, chunk_size: int = 64 * 1024) -> typing.Iterator[bytes]:
+        """
+        Yields document in parts of at least chunk_size (except the last one). Only
+        the current part is kept in memory. The first part already has converted
+        borders, so errors of borders_mapping are raised before anything is yielded
+        """
+        buffer = io.StringIO()
+        buffer.write(XML_DECLARATION)
+        buffer.write('<osm generator="osm-borders" version="0.6" upload="false">')
         for border in self.borders_mapping(self.borders):
             if self.filter(border):
-                self.dump_relation(out_xml, border)
+                self.dump_relation(buffer.write, border)
             else:
                 self.__log.debug("Filter excluded border: {0}".format(border))
-        return ET.tostring(out_xml, encoding="utf-8")
+            if buffer.tell() >= chunk_size:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+        buffer.write("</osm>")
+        yield buffer.getvalue().encode("utf-8")
 
-    def dump_relation(self, tree, border: Feature) -> None:
-        self.__log.debug("Dumping relation: {0}".format(border))
-        rel = ET.SubElement(tree, "relation", {"id": str(next(self.id_))})
-        (outer, inner) = self.dump_ways(tree, border)
+    @staticmethod
+    def _tags(write: typing.Callable[[str], typing.Any], tags) -> None:
+        for key, value in tags:
+            write("<tag k={0} v={1} />".format(_quote_attr(key), _quote_attr(value)))
 
+    def dump_relation(
+        self, write: typing.Callable[[str], typing.Any], border: Feature
+    ) -> None:
+        """
+        Writes relation of the border, after its ways and nodes
+        """
+        self.__log.debug("Dumping relation: {0}".format(border))
+        relation_id = next(self.id_)
+        (outer, inner) = self.dump_ways(write, border)
         # false positive
         # noinspection PyTypeChecker
-        for key, value in self.tag_mapping("relation", border.tags):
-            ET.SubElement(rel, "tag", {"k": key, "v": value})
+        self.write_relation(
+            write, relation_id, self.tag_mapping("relation", border.tags), outer, inner
+        )
+
+    def write_relation(
+        self,
+        write: typing.Callable[[str], typing.Any],
+        relation_id: int,
+        tags: typing.Iterable[typing.Tuple[str, str]],
+        outer: typing.List[int],
+        inner: typing.List[int],
+    ) -> None:
+        write('<relation id="{0}">'.format(relation_id))
+        self._tags(write, tags)
 
         for way in outer:
-            ET.SubElement(
-                rel, "member", {"ref": str(way), "role": "outer", "type": "way"}
-            )
+            write('<member ref="{0}" role="outer" type="way" />'.format(way))
 
         for way in inner:
-            ET.SubElement(
-                rel, "member", {"ref": str(way), "role": "inner", "type": "way"}
-            )
+            write('<member ref="{0}" role="inner" type="way" />'.format(way))
+        write("</relation>")
 
     def dump_ways(
-        self, tree, border: Feature
+        self, write: typing.Callable[[str], typing.Any], border: Feature
     ) -> typing.Tuple[typing.List[int], typing.List[int]]:
         outer = []
         inner = []
         geojson = shapely.geometry.mapping(border.geometry)
 
-        def algo(way: typing.List[typing.Tuple[float, float]]):
-            cached_way = self.__object_store["way"].get(way)
+        def algo(coords: typing.List[typing.Tuple[float, float]]):
+            way = way_key(coords)
+            if len(set(way)) < 2:
+                # way collapsed into a single node after rounding
+                self.__log.debug("Skipping degenerate way: {0}".format(coords))
+                return None
+            # relation members do not depend on way direction, so reuse ways that
+            # differ only by direction or starting point
+            key = canonical_way_key(way)
+            cached_way = self.__object_store["way"].get(key)
             if cached_way:
                 return cached_way
-            nodes = self.dump_points(tree, way, border.tags)
+            nodes = self.dump_points(write, way, border.tags)
             current_id = next(self.id_)
-            self.__object_store["way"][way] = current_id
-            way = ET.SubElement(tree, "way", {"id": str(current_id)})
-
+            self.__object_store["way"][key] = current_id
             # false positive
             # noinspection PyTypeChecker
-            for key, value in self.tag_mapping("way", border.tags):
-                ET.SubElement(way, "tag", {"k": key, "v": value})
-            for node in nodes:
-                ET.SubElement(way, "nd", {"ref": str(node)})
+            self.write_way(
+                write, current_id, self.tag_mapping("way", border.tags), nodes
+            )
             return current_id
 
         if geojson["type"] == "Polygon":
@@ -528,9 +1080,33 @@ class FeatureToOsm:
                         inner.append(algo(way))
         else:
             raise ValueError("Unkown GeoJSON Type found: {0}".format(geojson["type"]))
-        return outer, inner
+        return (
+            [x for x in outer if x is not None],
+            [x for x in inner if x is not None],
+        )
+
+    def write_way(
+        self,
+        write: typing.Callable[[str], typing.Any],
+        way_id: int,
+        tags: typing.Iterable[typing.Tuple[str, str]],
+        nodes: typing.List[int],
+    ) -> None:
+        write('<way id="{0}">'.format(way_id))
+        self._tags(write, tags)
+        for node in nodes:
+            write('<nd ref="{0}" />'.format(node))
+        write("</way>")
 
-    def dump_points(self, tree, points: list, tags: dict) -> typing.List[int]:
+    def dump_points(
+        self,
+        write: typing.Callable[[str], typing.Any],
+        points: typing.Iterable[int],
+        tags: dict,
+    ) -> typing.List[int]:
+        """
+        :param points: node keys, as returned by coordinate_key
+        """
         rv = []
         for point in points:
             cached_point = self.__object_store["point"].get(point)
@@ -539,26 +1115,47 @@ class FeatureToOsm:
             else:
                 current_id = next(self.id_)
                 self.__object_store["point"][point] = current_id
-                node = ET.SubElement(
-                    tree,
-                    "node",
-                    {"id": str(current_id), "lon": str(point[0]), "lat": str(point[1])},
-                )
                 # false positive
                 # noinspection PyTypeChecker
-                for key, value in self.tag_mapping("node", tags):
-                    ET.SubElement(node, "tag", {"k": key, "v": value})
+                self.write_node(
+                    write, current_id, self.tag_mapping("node", tags), point
+                )
             rv.append(current_id)
         return rv
 
+    def write_node(
+        self,
+        write: typing.Callable[[str], typing.Any],
+        node_id: int,
+        tags: typing.Iterable[typing.Tuple[str, str]],
+        point: int,
+    ) -> None:
+        """
+        :param point: node key, as returned by coordinate_key
+        """
+        tags = list(tags)
+        (lon, lat) = coordinate_from_key(point)
+        write(
+            '<node id="{0}" lon="{1}" lat="{2}"'.format(
+                node_id, format_coordinate(lon), format_coordinate(lat)
+            )
+        )
+        if tags:
+            write(">")
+            self._tags(write, tags)
+            write("</node>")
+        else:
+            write(" />")
+
+
+def gminy_prg_as_osm(terc: str) -> bytes:
+    return gminy_prg_converter(terc).tostring()
 
-def gminy_prg_as_osm(terc: str):
+
+def gminy_prg_converter(terc: str) -> FeatureToOsm:
     GMINY_DICT = GminyCache().get_cache()
-    borders = [
-        Feature.from_geojson(GMINY_DICT[x])
-        for x in GMINY_DICT.keys()
-        if x.startswith(terc)
-    ]
+    gminy = GMINY_DICT.get_many(GMINY_DICT.iter_prefix(terc))
+    borders = [Feature.from_geojson(x) for x in gminy.values()]
 
     for x in borders:
         x.geometry = x.geometry.boundary
@@ -595,5 +1192,4 @@ def gminy_prg_as_osm(terc: str):
         else:
             raise ValueError("Unknown object type: {0}".format(obj_type))
 
-    converter = FeatureToOsm(borders=borders, tag_mapping=tag_mapping)
-    return converter.tostring()
+    return FeatureToOsm(borders=borders, tag_mapping=tag_mapping)
@@ -0,0 +1,300 @@
+import collections
+import functools
+import io
+import json
+import logging
+import struct
+import typing
+import zlib
+
+import shapely.geometry
+import shapely.geometry.polygon
+
+from borders import fileformat_pb2, osmformat_pb2
+from borders.borders import FeatureToOsm, coordinate_from_key
+from borders.geoutils import get_raw_geometries
+
+__log = logging.getLogger(__name__)
+
+# maximum number of entities in one PBF block, as recommended by PBF format
+PBF_BLOCK_SIZE = 8000
+GZIP_LEVEL = 6
+
+
+def gzip_chunks(chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    """
+    Compresses chunks on the fly into gzip stream
+    """
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _round_coordinates(coords, digits: int = 7):
+    if coords and isinstance(coords[0], (float, int)):
+        return [round(x, digits) for x in coords]
+    return [_round_coordinates(x, digits) for x in coords]
+
+
+def as_polygons(
+    geometry: shapely.geometry.base.BaseGeometry
+) -> shapely.geometry.base.BaseGeometry:
+    """
+    Returns area enclosed by border rings, e.g. polygon with holes from boundary of
+    that polygon. Rings within odd number of other rings are holes. Geometries that
+    are not made of closed rings are returned as they are
+    """
+    if geometry.geom_type in ("Polygon", "MultiPolygon"):
+        return geometry
+    lines = get_raw_geometries(geometry)
+    if not lines or not all(
+        isinstance(x, shapely.geometry.LineString) and x.is_closed and len(x.coords) > 3
+        for x in lines
+    ):
+        return geometry
+    rv = functools.reduce(
+        lambda x, y: x.symmetric_difference(y),
+        (shapely.geometry.Polygon(x.coords) for x in lines),
+    )
+    # GeoJSON requires counterclockwise exterior rings
+    if isinstance(rv, shapely.geometry.Polygon):
+        return shapely.geometry.polygon.orient(rv)
+    return shapely.geometry.MultiPolygon(
+        [shapely.geometry.polygon.orient(x) for x in get_raw_geometries(rv)]
+    )
+
+
+class FeatureToGeoJson(FeatureToOsm):
+    """
+    Writes each relation as GeoJSON feature with relation tags as properties and
+    (Multi)Polygon of the border as geometry. Features do not share ways, so
+    borders_mapping is not used
+    """
+
+    __log = logging.getLogger(__name__)
+
+    def iter_chunks(self, chunk_size: int = 64 * 1024) -> typing.Iterator[bytes]:
+        buffer = io.StringIO()
+        buffer.write('{"type": "FeatureCollection", "features": [')
+        separator = ""
+        for border in self.borders:
+            if not self.filter(border):
+                self.__log.debug("Filter excluded border: {0}".format(border))
+                continue
+            geometry = shapely.geometry.mapping(as_polygons(border.geometry))
+            if geometry.get("coordinates"):
+                geometry["coordinates"] = _round_coordinates(geometry["coordinates"])
+            buffer.write(separator)
+            separator = ", "
+            json.dump(
+                {
+                    "type": "Feature",
+                    # false positive
+                    # noinspection PyTypeChecker
+                    "properties": dict(self.tag_mapping("relation", border.tags)),
+                    "geometry": geometry,
+                },
+                buffer,
+                ensure_ascii=False,
+            )
+            if buffer.tell() >= chunk_size:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+        buffer.write("]}")
+        yield buffer.getvalue().encode("utf-8")
+
+
+class FeatureToPbf(FeatureToOsm):
+    """
+    Writes OSM PBF file. Entities are collected into blocks of PBF_BLOCK_SIZE, each
+    block has groups of nodes, ways and relations in that order, so objects are
+    always written before they are referenced
+    """
+
+    __log = logging.getLogger(__name__)
+
+    def __init__(self, *args, **kwargs):
+        super(FeatureToPbf, self).__init__(*args, **kwargs)
+        self.__nodes = []
+        self.__ways = []
+        self.__relations = []
+        self.__block_size = PBF_BLOCK_SIZE
+        self.__blocks = []  # blocks that are full, but not yet yielded
+
+    def iter_chunks(self, chunk_size: int = PBF_BLOCK_SIZE) -> typing.Iterator[bytes]:
+        """
+        Yields file header together with the first blocks, and then blocks as they
+        are filled
+
+        :param chunk_size: number of entities in one block
+        """
+        header = osmformat_pb2.HeaderBlock(
+            required_features=["OsmSchema-V0.6", "DenseNodes"],
+            writingprogram="osm-borders",
+        )
+        self.__block_size = chunk_size
+        rv = self._blob("OSMHeader", header.SerializeToString())
+        for border in self.borders_mapping(self.borders):
+            if self.filter(border):
+                self.dump_relation(None, border)
+            else:
+                self.__log.debug("Filter excluded border: {0}".format(border))
+            if self.__blocks:
+                yield rv + b"".join(self.__blocks)
+                rv = b""
+                self.__blocks = []
+        if self._pending():
+            rv += self._flush()
+        if rv:
+            yield rv
+
+    def write_node(self, write, node_id, tags, point) -> None:
+        self.__nodes.append((node_id, list(tags), point))
+        self._check_block()
+
+    def write_way(self, write, way_id, tags, nodes) -> None:
+        self.__ways.append((way_id, list(tags), nodes))
+        self._check_block()
+
+    def write_relation(self, write, relation_id, tags, outer, inner) -> None:
+        self.__relations.append((relation_id, list(tags), outer, inner))
+        self._check_block()
+
+    def _pending(self) -> int:
+        return len(self.__nodes) + len(self.__ways) + len(self.__relations)
+
+    def _check_block(self) -> None:
+        """
+        Closes the block as soon as it has block size entities, as a single border
+        may have many more of them
+        """
+        if self._pending() >= self.__block_size:
+            self.__blocks.append(self._flush())
+
+    @staticmethod
+    def _blob(blob_type: str, data: bytes) -> bytes:
+        blob = fileformat_pb2.Blob(
+            raw_size=len(data), zlib_data=zlib.compress(data)
+        ).SerializeToString()
+        header = fileformat_pb2.BlobHeader(
+            type=blob_type, datasize=len(blob)
+        ).SerializeToString()
+        return struct.pack("!I", len(header)) + header + blob
+
+    def _flush(self) -> bytes:
+        strings = {"": 0}
+
+        def sid(value: str) -> int:
+            return strings.setdefault(value, len(strings))
+
+        def delta(values: typing.Iterable[int]) -> typing.List[int]:
+            rv = []
+            last = 0
+            for value in values:
+                rv.append(value - last)
+                last = value
+            return rv
+
+        block = osmformat_pb2.PrimitiveBlock()
+        if self.__nodes:
+            dense = block.primitivegroup.add().dense
+            coords = [coordinate_from_key(x[2]) for x in self.__nodes]
+            dense.id.extend(delta(x[0] for x in self.__nodes))
+            dense.lon.extend(delta(x[0] for x in coords))
+            dense.lat.extend(delta(x[1] for x in coords))
+            if any(x[1] for x in self.__nodes):
+                for (_, tags, _) in self.__nodes:
+                    for (key, value) in tags:
+                        dense.keys_vals.extend((sid(key), sid(value)))
+                    dense.keys_vals.append(0)
+        if self.__ways:
+            group = block.primitivegroup.add()
+            for (way_id, tags, nodes) in self.__ways:
+                way = group.ways.add(id=way_id, refs=delta(nodes))
+                way.keys.extend(sid(key) for (key, _) in tags)
+                way.vals.extend(sid(value) for (_, value) in tags)
+        if self.__relations:
+            group = block.primitivegroup.add()
+            for (relation_id, tags, outer, inner) in self.__relations:
+                relation = group.relations.add(id=relation_id)
+                relation.keys.extend(sid(key) for (key, _) in tags)
+                relation.vals.extend(sid(value) for (_, value) in tags)
+                relation.memids.extend(delta(outer + inner))
+                relation.roles_sid.extend(
+                    [sid("outer")] * len(outer) + [sid("inner")] * len(inner)
+                )
+                relation.types.extend(
+                    [osmformat_pb2.Relation.WAY] * (len(outer) + len(inner))
+                )
+        block.stringtable.s.extend(x.encode("utf-8") for x in strings)
+        self.__nodes = []
+        self.__ways = []
+        self.__relations = []
+        return self._blob("OSMData", block.SerializeToString())
+
+
+OutputFormat = collections.namedtuple(
+    "OutputFormat", ["mimetype", "extension", "iter_chunks"]
+)
+
+OUTPUT_FORMATS = {
+    "osm": OutputFormat(
+        "text/xml; charset=utf-8", "osm", lambda converter: converter.iter_chunks()
+    ),
+    "osm.gz": OutputFormat(
+        "application/gzip",
+        "osm.gz",
+        lambda converter: gzip_chunks(converter.iter_chunks()),
+    ),
+    "pbf": OutputFormat(
+        "application/x-protobuf",
+        "osm.pbf",
+        lambda converter: FeatureToPbf.from_converter(converter).iter_chunks(),
+    ),
+    "geojson": OutputFormat(
+        "application/geo+json",
+        "geojson",
+        lambda converter: FeatureToGeoJson.from_converter(converter).iter_chunks(),
+    ),
+}
+
+
+def format_from_filename(filename: str) -> typing.Optional[str]:
+    """
+    :return: name of the output format matching filename extension, None if none
+    matches
+    """
+    for (name, output_format) in sorted(
+        OUTPUT_FORMATS.items(), key=lambda x: -len(x[1].extension)
+    ):
+        if filename.endswith("." + output_format.extension):
+            return name
+    return None
+
+
+def format_from_mimetype(mimetype: str) -> typing.Optional[str]:
+    for (name, output_format) in OUTPUT_FORMATS.items():
+        if output_format.mimetype.split(";")[0] == mimetype:
+            return name
+    return None
+
+
+def write(converter: FeatureToOsm, output: typing.BinaryIO, output_format: str) -> int:
+    """
+    Writes converted borders to output in given format
+
+    :param converter: converter with borders
+    :param output: binary file to write to
+    :param output_format: key of OUTPUT_FORMATS
+    :return: number of bytes written
+    """
+    rv = 0
+    for chunk in OUTPUT_FORMATS[output_format].iter_chunks(converter):
+        output.write(chunk)
+        rv += len(chunk)
+    __log.debug("Wrote {0} bytes as {1}".format(rv, output_format))
+    return rv
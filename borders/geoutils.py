@@ -1,12 +1,29 @@
-import itertools
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import os
+import threading
 import typing
 from converters.feature import Feature
 import shapely.geometry
 import shapely.ops
+import shapely.strtree
+import shapely.wkb
 import logging
 
 __log = logging.getLogger(__name__)
 
+# number of processes used by split_by_components, defaults to number of CPUs
+SPLIT_WORKERS = int(os.environ.get("SPLIT_WORKERS", 0)) or None
+# below this number of borders splitting is done in the calling process
+SPLIT_MIN_PARALLEL_BORDERS = 50
+
+# process pool shared by all split_by_components calls, and process that started it
+_split_executor = None  # type: typing.Optional[concurrent.futures.ProcessPoolExecutor]
+_split_executor_pid = None
+_split_executor_lock = threading.Lock()
+
 
 def get_raw_geometries(
     obj: shapely.geometry.base.BaseGeometry
@@ -69,13 +86,34 @@ def split_intersec(
     return rv
 
 
-def split_by_common_ways(borders: typing.List[Feature]) -> typing.List[Feature]:
-    for (border, other) in itertools.combinations(borders, 2):
-        __log.debug(
-            "Processing border ({0}, {1})".format(
-                borders.index(border), borders.index(other)
-            )
+def candidate_pairs(
+    geometries: typing.List[shapely.geometry.base.BaseGeometry]
+) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Returns index pairs (i, j), i < j, of geometries with intersecting envelopes, in
+    the same order as itertools.combinations. Other pairs can't share any way.
+    """
+    tree = shapely.strtree.STRtree(geometries)
+    index_by_id = dict((id(geom), i) for i, geom in enumerate(geometries))
+    rv = []
+    for i, geom in enumerate(geometries):
+        if geom.is_empty:
+            continue
+        rv.extend(
+            (i, j)
+            for j in sorted(index_by_id[id(x)] for x in tree.query(geom))
+            if j > i
         )
+    return rv
+
+
+def split_by_common_ways(borders: typing.List[Feature]) -> typing.List[Feature]:
+    # splitting only rearranges linework of a border, so its envelope doesn't change
+    # and candidates can be computed once, up front
+    for (i, j) in candidate_pairs([x.geometry for x in borders]):
+        __log.debug("Processing border ({0}, {1})".format(i, j))
+        border = borders[i]
+        other = borders[j]
         intersec = border.geometry.intersection(other.geometry)
         if intersec.is_empty:
             continue  # nothing will change anyway
@@ -94,3 +132,175 @@ def split_by_common_ways(borders: typing.List[Feature]) -> typing.List[Feature]:
             intersec, other.geometry.difference(intersec)
         )
     return borders
+
+
+def split_by_topology(
+    borders: typing.List[Feature], tolerance: float = 1e-13
+) -> typing.List[Feature]:
+    """
+    Alternative to split_by_common_ways. All linework is noded once into a planar
+    graph, each edge is assigned to the set of borders that contain it and edges
+    with the same owners are merged into ways shared by all of the owners.
+
+    :param borders: features with (Multi)LineString geometries
+    :param tolerance: max distance of an edge from a border to count as owned by it
+    :return: borders, with geometries replaced by MultiLineStrings of shared ways
+    """
+    lines = []
+    line_owner = []
+    for i, border in enumerate(borders):
+        for line in get_raw_geometries(border.geometry):
+            if isinstance(line, shapely.geometry.LineString):
+                lines.append(shapely.geometry.LineString(line.coords))
+                line_owner.append(i)
+
+    edges = get_raw_geometries(shapely.ops.unary_union(lines))
+    __log.debug("Noded {0} borders into {1} edges".format(len(borders), len(edges)))
+
+    tree = shapely.strtree.STRtree(lines)
+    index_by_id = dict((id(line), i) for i, line in enumerate(lines))
+    owners = collections.OrderedDict()
+    for edge in edges:
+        # noding splits lines wherever owners change, so one point of an edge is enough
+        probe = edge.interpolate(0.5, normalized=True)
+        candidates = tree.query(edge)
+        if len(candidates) > 1:
+            distances = [x.distance(probe) for x in candidates]
+            limit = min(distances)
+            # edges moved by noding robustness fallbacks are further than tolerance
+            # from all lines, they go to all lines as close as the closest one
+            limit = tolerance if limit <= tolerance else limit + tolerance
+            candidates = [x for (x, d) in zip(candidates, distances) if d <= limit]
+        key = tuple(sorted(set(line_owner[index_by_id[id(x)]] for x in candidates)))
+        owners.setdefault(key, []).append(edge)
+
+    ways = [[] for _ in borders]
+    for key, owned_edges in owners.items():
+        merged = get_raw_geometries(
+            try_linemerge(shapely.geometry.MultiLineString(owned_edges))
+        )
+        for i in key:
+            ways[i].extend(merged)
+
+    for border, border_ways in zip(borders, ways):
+        border.geometry = shapely.geometry.MultiLineString(border_ways)
+    return borders
+
+
+def connected_components(
+    geometries: typing.List[shapely.geometry.base.BaseGeometry]
+) -> typing.List[typing.List[int]]:
+    """
+    Groups indexes of geometries that touch or intersect each other, directly or
+    through other geometries. Indexes in each group are sorted, groups are ordered by
+    their first index.
+    """
+    parent = list(range(len(geometries)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (i, j) in candidate_pairs(geometries):
+        if find(i) != find(j) and geometries[i].intersects(geometries[j]):
+            parent[find(j)] = find(i)
+
+    rv = collections.OrderedDict()
+    for i in range(len(geometries)):
+        rv.setdefault(find(i), []).append(i)
+    return list(rv.values())
+
+
+def get_split_executor() -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Returns process pool of SPLIT_WORKERS processes, shared by all requests. Pool is
+    created on first use, so each forked server worker gets its own
+    """
+    global _split_executor, _split_executor_pid
+    with _split_executor_lock:
+        if _split_executor is None or _split_executor_pid != os.getpid():
+            _split_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=SPLIT_WORKERS
+            )
+            _split_executor_pid = os.getpid()
+        return _split_executor
+
+
+def _reset_split_executor(executor: concurrent.futures.ProcessPoolExecutor) -> None:
+    """
+    Drops broken shared pool, so the next call starts a new one
+    """
+    global _split_executor
+    with _split_executor_lock:
+        if _split_executor is executor:
+            _split_executor = None
+    executor.shutdown(wait=False)
+
+
+def _split_wkb(
+    geometries: typing.List[bytes],
+    borders_mapping: typing.Callable[[typing.List[Feature]], typing.List[Feature]],
+) -> typing.List[bytes]:
+    borders = [Feature(shapely.wkb.loads(x)) for x in geometries]
+    return [x.geometry.wkb for x in borders_mapping(borders)]
+
+
+def split_by_components(
+    borders: typing.List[Feature],
+    borders_mapping: typing.Callable[
+        [typing.List[Feature]], typing.List[Feature]
+    ] = split_by_common_ways,
+    max_workers: typing.Optional[int] = None,
+    min_borders: int = SPLIT_MIN_PARALLEL_BORDERS,
+) -> typing.List[Feature]:
+    """
+    Runs borders_mapping separately on each group of connected borders, in a process
+    pool. Borders from different groups can't share ways, so the result is the same
+    as running borders_mapping on all of them.
+
+    :param borders: borders to split
+    :param borders_mapping: module level (picklable) splitting function
+    :param max_workers: size of process pool created for this call only, None - use
+        pool shared by all calls, see get_split_executor
+    :param min_borders: below this number of borders, split in this process
+    :return: borders, in the original order, with geometries replaced
+    """
+    if len(borders) < min_borders or (max_workers or SPLIT_WORKERS) == 1:
+        return borders_mapping(borders)
+
+    components = connected_components([x.geometry for x in borders])
+    if len(components) < 2:
+        return borders_mapping(borders)
+    __log.info(
+        "Splitting {0} borders in {1} groups".format(len(borders), len(components))
+    )
+
+    if max_workers is None:
+        context = contextlib.nullcontext(get_split_executor())
+    else:
+        context = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    with context as executor:
+        try:
+            # start biggest groups first, they take the most time
+            futures = dict(
+                (
+                    executor.submit(
+                        _split_wkb,
+                        [borders[i].geometry.wkb for i in component],
+                        borders_mapping,
+                    ),
+                    component,
+                )
+                for component in sorted(components, key=len, reverse=True)
+            )
+            for future in concurrent.futures.as_completed(futures):
+                for i, geometry in zip(futures[future], future.result()):
+                    borders[i].geometry = shapely.wkb.loads(geometry)
+        except concurrent.futures.process.BrokenProcessPool:
+            # worker was killed, e.g. out of memory
+            if max_workers is None:
+                _reset_split_executor(executor)
+            raise
+    return borders
@@ -1,4 +1,8 @@
 import json
+import logging
+import os
+import threading
+import time
 import typing
 import urllib.parse
 
@@ -6,6 +10,21 @@ import requests
 import shapely.geometry
 import shapely.wkt
 
+from converters.tools import Cache, JsonSerializer, get_cache_manager
+
+__log = logging.getLogger(__name__)
+
+WIKIDATA_CACHE_NAME = "osm_wikidata_v1"
+WIKIDATA_TTL = 24 * 3600
+WIKIDATA_TIMEOUT = 60
+# length of TERC prefix fetched in one query on cache miss: 7 - gmina, 4 - powiat,
+# 2 - wojewodztwo
+WIKIDATA_BATCH = {"gmina": 7, "powiat": 4, "wojewodztwo": 2}[
+    os.environ.get("WIKIDATA_BATCH", "powiat")
+]
+
+_wikidata_cache_lock = threading.Lock()
+
 
 class WikidataSimcEntry:
     def __init__(self, dct):
@@ -44,13 +63,63 @@ class WikidataSimcEntry:
         return self.wikipedia + "/" + self.wikidata
 
 
-def fetch_from_wikidata(terc: str) -> typing.List[WikidataSimcEntry]:
+def get_wikidata_cache() -> typing.Optional[Cache]:
+    try:
+        return get_cache_manager().get_or_create_cache(
+            WIKIDATA_CACHE_NAME, serializer=JsonSerializer()
+        )
+    except Exception as e:
+        __log.warning("Wikidata cache unavailable: {0}".format(e))
+        return None
+
+
+def fetch_from_wikidata(
+    terc: str, batch: int = WIKIDATA_BATCH
+) -> typing.List[WikidataSimcEntry]:
+    """
+    Returns Wikidata entries of gmina, cached for WIKIDATA_TTL.
+
+    :param terc: TERC of gmina
+    :param batch: length of TERC prefix that is fetched and cached at once on cache
+                  miss, e.g. 4 to fetch the whole powiat
+    """
+    with _wikidata_cache_lock:
+        cache = get_wikidata_cache()
+        entry = None
+        if cache:
+            try:
+                entry = cache.get(terc)
+            except Exception as e:
+                __log.warning("Reading {0} from Wikidata cache: {1}".format(terc, e))
+    if entry and entry["time"] + WIKIDATA_TTL > time.time():
+        return [WikidataSimcEntry(x) for x in entry["bindings"]]
+
+    by_terc = fetch_bindings(terc[:batch])
+    # gmina is stored even without any entries, so it isn't fetched again
+    bindings = by_terc.setdefault(terc, [])
+    if cache:
+        now = time.time()
+        with _wikidata_cache_lock:
+            try:
+                for (key, value) in by_terc.items():
+                    cache.add(key, {"time": now, "bindings": value})
+            except Exception as e:
+                __log.warning("Storing {0} in Wikidata cache: {1}".format(terc, e))
+    return [WikidataSimcEntry(x) for x in bindings]
+
+
+def fetch_bindings(terc_prefix: str) -> typing.Dict[str, typing.List[dict]]:
+    """
+    Runs one SPARQL query for all gminas with TERC starting with terc_prefix
+
+    :return: result bindings by gmina TERC
+    """
     query = """
     SELECT ?miejscowosc ?miejscowoscLabel ?gmina ?terc ?article ?coords
     WHERE
     {{
         ?gmina wdt:P1653 ?terc
-        filter (?terc = '{0}') .
+        filter (strstarts(?terc, '{0}')) .
         ?miejscowosc wdt:P131 ?gmina .
         ?article schema:about ?miejscowosc .
         ?article schema:inLanguage "pl" .
@@ -58,12 +127,19 @@ def fetch_from_wikidata(terc: str) -> typing.List[WikidataSimcEntry]:
         SERVICE wikibase:label {{ bd:serviceParam wikibase:language "pl" }}
     }}
     """.format(
-        terc
+        terc_prefix
     )
+    __log.info("Downloading Wikidata entries for TERC: {0}".format(terc_prefix))
     resp = requests.get(
-        "https://query.wikidata.org/sparql", params={"query": query, "format": "json"}
+        "https://query.wikidata.org/sparql",
+        params={"query": query, "format": "json"},
+        timeout=WIKIDATA_TIMEOUT,
     )
-    return from_json(resp.text)
+    resp.raise_for_status()
+    rv = {}
+    for binding in json.loads(resp.text)["results"]["bindings"]:
+        rv.setdefault(binding["terc"]["value"], []).append(binding)
+    return rv
 
 
 def from_json(s: str) -> typing.List[WikidataSimcEntry]:
@@ -1,3 +1,5 @@
+import hashlib
+
 import shapely.geometry
 
 
@@ -41,16 +43,26 @@ class Feature:
         return Feature(geometry, tags)
 
 
+def geometry_fingerprint(geometry: shapely.geometry.base.BaseGeometry) -> bytes:
+    """
+    Digest of WKB of the geometry. Equal for geometries with exactly the same
+    coordinates, like in BaseGeometry.__eq__
+    """
+    return hashlib.blake2b(geometry.wkb, digest_size=16).digest()
+
+
 class ImmutableFeature:
     def __init__(self, feature: Feature):
         self.geometry = feature.geometry
         self.tags = tuple(sorted(list(feature.tags.items())))
+        self.fingerprint = geometry_fingerprint(self.geometry)
+        self._hash = hash((self.fingerprint, self.tags))
 
     def __eq__(self, other):
-        return self.geometry == other.geometry and self.tags == other.tags
+        return self.fingerprint == other.fingerprint and self.tags == other.tags
 
     def __hash__(self):
-        return hash((self.geometry.wkt, self.tags))
+        return self._hash
 
     def to_feature(self):
         return Feature(self.geometry, dict(self.tags))
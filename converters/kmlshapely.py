@@ -1,7 +1,13 @@
+import html
 import logging
-from typing import List
-from xml.etree.ElementTree import Element, fromstring
+import os
+import re
+from typing import Callable, Dict, Iterable, Iterator, List
+from xml.etree.ElementTree import Element, XMLPullParser, fromstring
 
+import lxml.etree
+import lxml.html
+import numpy
 from bs4 import BeautifulSoup
 from shapely.geometry.base import BaseGeometry
 from shapely.geometry.polygon import Polygon
@@ -15,67 +21,162 @@ ns = "{http://www.opengis.net/kml/2.2}"
 
 Borders = List[Feature]
 Shapes = List[BaseGeometry]
+DescriptionParser = Callable[[str], Dict[str, str]]
 
 
-def kml_to_shapely(data: str) -> Borders:
+def description_tags_bs4(description: str) -> Dict[str, str]:
+    """
+    Reference parser of placemark description, slow but most forgiving
+    """
+    soup = BeautifulSoup(description, "html.parser")
+    return dict(
+        zip(
+            map(lambda x: x.text, soup.find_all("span", class_="atr-name")),
+            map(lambda x: x.text, soup.find_all("span", class_="atr-value")),
+        )
+    )
+
+
+def _xpath_class(cls: str) -> lxml.etree.XPath:
+    return lxml.etree.XPath(
+        '//*[contains(concat(" ", normalize-space(@class), " "), " {0} ")]'.format(cls)
+    )
+
+
+_xpath_atr_name = _xpath_class("atr-name")
+_xpath_atr_value = _xpath_class("atr-value")
+
+
+def description_tags_lxml(description: str) -> Dict[str, str]:
+    root = lxml.html.fromstring(description)
+    return dict(
+        zip(
+            (x.text_content() for x in _xpath_atr_name(root)),
+            (x.text_content() for x in _xpath_atr_value(root)),
+        )
+    )
+
+
+_atr_re = re.compile(r'<span class="atr-(name|value)">([^<]*)</span>')
+
+
+def description_tags_fast(description: str) -> Dict[str, str]:
+    """
+    Reads attributes from plain spans as generated by EMUiA. Falls back to lxml when
+    description has any other markup within or around attributes
+    """
+    names = []
+    values = []
+    for (kind, text) in _atr_re.findall(description):
+        (names if kind == "name" else values).append(html.unescape(text))
+    expected = (description.count("atr-name"), description.count("atr-value"))
+    if (len(names), len(values)) != expected:
+        return description_tags_lxml(description)
+    return dict(zip(names, values))
+
+
+DESCRIPTION_PARSERS = {
+    "bs4": description_tags_bs4,
+    "lxml": description_tags_lxml,
+    "fast": description_tags_fast,
+}
+DESCRIPTION_PARSER = DESCRIPTION_PARSERS[
+    os.environ.get("KML_DESCRIPTION_PARSER", "fast")
+]
+
+
+def kml_to_shapely(
+    data: str, description_parser: DescriptionParser = DESCRIPTION_PARSER
+) -> Borders:
     """
 
     :rtype: Borders
     :param data:
+    :param description_parser: one of DESCRIPTION_PARSERS
     """
 
     tree = fromstring(data)
-    rv = []
-    for placemark in tree.findall(".//" + ns + "Placemark"):
-        name = placemark.findtext(ns + "name")
-        __log.debug("Parsing placemark: %s", name)
-        # MultiGeometry lub LinearRing?
-        geo = placemark.find(ns + "MultiGeometry")
-        description = BeautifulSoup(
-            placemark.findtext("{http://www.opengis.net/kml/2.2}description"),
-            "html.parser",
+    return [
+        placemark_to_feature(placemark, description_parser)
+        for placemark in tree.findall(".//" + ns + "Placemark")
+    ]
+
+
+def iter_kml_to_shapely(
+    chunks: Iterable[bytes], description_parser: DescriptionParser = DESCRIPTION_PARSER
+) -> Iterator[Feature]:
+    """
+    Parses KML fed in chunks of bytes and yields features as soon as their placemark
+    is read. Parsed placemarks are removed from the tree, so whole document is never
+    kept in memory.
+
+    Raises xml.etree.ElementTree.ParseError when data is not a well-formed XML and
+    ValueError when it is not a KML document
+
+    :param chunks: raw (not decoded) KML document
+    :param description_parser: one of DESCRIPTION_PARSERS
+    """
+    parser = XMLPullParser(events=("start", "end"))
+    stack = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        for (event, element) in parser.read_events():
+            if event == "start":
+                if not stack and element.tag != ns + "kml":
+                    raise ValueError(
+                        "Not a KML document. Root element: {0}".format(element.tag)
+                    )
+                stack.append(element)
+                continue
+            stack.pop()
+            if element.tag == ns + "Placemark":
+                yield placemark_to_feature(element, description_parser)
+                if stack:
+                    stack[-1].remove(element)
+    parser.close()
+
+
+def placemark_to_feature(
+    placemark: Element, description_parser: DescriptionParser = DESCRIPTION_PARSER
+) -> Feature:
+    name = placemark.findtext(ns + "name")
+    __log.debug("Parsing placemark: %s", name)
+    # MultiGeometry lub LinearRing?
+    geo = placemark.find(ns + "MultiGeometry")
+    tags = description_parser(placemark.findtext(ns + "description"))
+    outer = []
+    inner = []
+    for polygon in geo.findall(ns + "Polygon"):
+        outer.extend(
+            ring_to_shape(x)
+            for x in polygon.findall(ns + "outerBoundaryIs/" + ns + "LinearRing")
         )
-        tags = dict(
-            zip(
-                map(lambda x: x.text, description.find_all("span", class_="atr-name")),
-                map(lambda x: x.text, description.find_all("span", class_="atr-value")),
-            )
+        inner.extend(
+            ring_to_shape(x)
+            for x in polygon.findall(ns + "innerBoundaryIs/" + ns + "LinearRing")
         )
-        outer = Polygon()
-        inner = Polygon()
-        for polygon in geo.findall(ns + "Polygon"):
-            outer = cascaded_union(
-                [
-                    ring_to_shape(x)
-                    for x in polygon.findall(
-                        ns + "outerBoundaryIs/" + ns + "LinearRing"
-                    )
-                ]
-                + [outer]
-            )
-            inner = cascaded_union(
-                [
-                    ring_to_shape(x)
-                    for x in polygon.findall(
-                        ns + "innerBoundaryIs/" + ns + "LinearRing"
-                    )
-                ]
-                + [inner]
-            )
-        border = Feature(outer.difference(inner))
-        border.set_tag("name", name)
-        for key, value in tags.items():
-            border.set_tag(key, value)
-        rv.append(border)
-    return rv
+    # empty polygon keeps result a Polygon, when placemark has no rings
+    outer = cascaded_union(outer + [Polygon()])
+    inner = cascaded_union(inner + [Polygon()])
+    border = Feature(outer.difference(inner))
+    border.set_tag("name", name)
+    for key, value in tags.items():
+        border.set_tag(key, value)
+    return border
 
 
 def ring_to_shape(tree: Element) -> BaseGeometry:
-    coordinates = []
-    for point_text in tree.findtext(ns + "coordinates").split():
-        floats = point_text.split(",")
-        coordinates.append((float(floats[0]), float(floats[1])))
-    if coordinates[0] == coordinates[-1]:
+    text = tree.findtext(ns + "coordinates")
+    # tuples are "lon,lat" or "lon,lat,alt"
+    tuples = text.split()
+    dimensions = tuples[0].count(",") + 1
+    values = numpy.array(text.replace(",", " ").split(), dtype=float)
+    if len(values) != len(tuples) * dimensions:
+        raise ValueError(
+            "Coordinates with mixed dimensions: {0}".format(text[:100].strip())
+        )
+    coordinates = values.reshape(-1, dimensions)[:, :2]
+    if (coordinates[0] == coordinates[-1]).all():
         return Polygon(coordinates)
     else:
         raise Exception("Not a polygon")
@@ -117,6 +117,11 @@ def update():
         cache().get_cache()
 
 
+def snapshot():
+    for cache in __all_caches__:
+        cache().create_snapshot()
+
+
 class TqdmUpTo(tqdm.tqdm):
     def update_to(self, b=1, bsize=1, tsize=None):
         if tsize is not None:
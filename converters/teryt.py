@@ -26,7 +26,7 @@ from .teryt_pb2 import (
     SimcEntry as SimcEntry_pb,
     UlicMultiEntry as UlicMultiEntry_pb,
 )
-from .tools import VersionedCache, CacheNotInitialized
+from .tools import VersionedCache, CacheNotInitialized, create_snapshot
 from .tools import groupby, get_cache_manager, ProtoSerializer, Cache, synchronized
 
 TERYT_SIMC_DB = "osm_teryt_simc_v1"
@@ -929,7 +929,7 @@ class BaseTerytCache(VersionedCache[T]):
 
     @synchronized
     def update_cache(self, from_version: Version, target_version: Version):
-        cache = self._get_cache(from_version)
+        cache = self._get_cache_for_update(from_version)
         # noinspection PyBroadException
         try:
             with self._get_updates(from_version, target_version) as data_file:
@@ -1363,3 +1363,10 @@ def verify():
     TerytCache().verify()
     SimcCache().verify()
     UlicCache().verify()
+
+
+def snapshot():
+    create_snapshot(TERYT_WMRODZ_DB)
+    TerytCache().create_snapshot()
+    SimcCache().create_snapshot()
+    UlicCache().create_snapshot()
@@ -1,16 +1,23 @@
+import bisect
 import functools
 import threading
 
 import collections
+import contextlib
 import dbm
 import json
 import logging
+import mmap
 import os
 import shelve
+import sqlite3
+import struct
 import tempfile
 import time
 import typing
+import urllib.request
 
+import cachetools
 import tqdm
 from google.protobuf import message
 from google.protobuf.descriptor import FieldDescriptor
@@ -75,6 +82,13 @@ class ProtoSerializer(Serializer):
 
 
 class Cache(typing.Generic[T]):
+    # sorted list of keys, built on first iter_prefix call
+    _key_index = None  # type: typing.Optional[typing.List[str]]
+    # version of cache contents the key index was built for
+    _key_index_version = None  # type: typing.Optional[int]
+    # returns current version of cache contents, when other processes may change it
+    version_getter = None  # type: typing.Optional[typing.Callable[[], int]]
+
     def get(self, name: str, default: T = None) -> typing.Optional[T]:
         raise NotImplementedError
 
@@ -84,10 +98,101 @@ class Cache(typing.Generic[T]):
     def delete(self, name: str):
         raise NotImplementedError
 
+    def get_many(self, names: typing.Iterable[str]) -> typing.Dict[str, T]:
+        """
+        Returns values for all names found in the cache. Missing names are left out
+        """
+        rv = {}
+        for name in names:
+            value = self.get(name)
+            if value is not None:
+                rv[name] = value
+        return rv
+
+    def get_many_serialized(
+        self, names: typing.Iterable[str], serializer: Serializer
+    ) -> typing.Dict[str, bytes]:
+        """
+        Returns serialized values for all names found in the cache. Caches that store
+        serialized values return them as they are stored, without decoding them
+
+        :param serializer: serializer of cache values, used only by caches that keep
+            decoded values
+        """
+        return dict(
+            (name, serializer.serialize(value))
+            for (name, value) in self.get_many(names).items()
+        )
+
+    def iter_prefix(self, prefix: str) -> typing.Iterator[str]:
+        """
+        Returns keys starting with prefix, in sorted order. Cost is proportional to
+        the number of keys returned, once the key index is built
+
+        :param prefix: beginning of the keys, e.g. TERC of the parent unit
+        """
+        index = self._get_key_index()
+        start = bisect.bisect_left(index, prefix)
+        end = start
+        while end < len(index) and index[end].startswith(prefix):
+            end += 1
+        return iter(index[start:end])
+
+    def _get_key_index(self) -> typing.List[str]:
+        version = self.version_getter() if self.version_getter else None
+        if self._key_index is None or self._key_index_version != version:
+            # new version may come from other process, e.g. other gunicorn worker
+            self._key_index = sorted(self.keys())
+            self._key_index_version = version
+        return self._key_index
+
+    def _index_add(self, name: str):
+        index = self._key_index
+        if index is not None:
+            position = bisect.bisect_left(index, name)
+            if position == len(index) or index[position] != name:
+                index.insert(position, name)
+
+    def _index_delete(self, name: str):
+        index = self._key_index
+        if index is not None:
+            position = bisect.bisect_left(index, name)
+            if position < len(index) and index[position] == name:
+                del index[position]
+
+    def _index_reload(
+        self, index: typing.Optional[typing.List[str]], names: typing.Iterable[str]
+    ):
+        """
+        Updates key index after bulk load of names. Index that wasn't built before
+        the load is built on first iter_prefix call
+
+        :param index: key index from before the load, None if it wasn't built
+        """
+        if index is not None:
+            self._key_index = sorted(set(index).union(names))
+
+    def reset_key_index(self):
+        """
+        Drops key index, e.g. when cache contents were replaced by other process
+        """
+        self._key_index = None
+
+    def invalidate(self):
+        """
+        Drops all state derived from cache contents. Called when new version of the
+        cache is marked ready
+        """
+        self.reset_key_index()
+
     @synchronized
     def reload(self, contents: typing.Dict[str, T]):
+        index = self._key_index
+        # don't update index for each added key
+        self._key_index = None
         for key, value in tqdm.tqdm(contents.items(), desc="Reloading cache"):
             self.add(key, value)
+        self._index_reload(index, contents.keys())
 
     def __getitem__(self, item):
         ret = self.get(item)
@@ -102,8 +207,117 @@ class Cache(typing.Generic[T]):
         raise NotImplementedError
 
 
+# number of decoded entries kept in memory for each versioned cache, 0 - disabled
+CACHE_LRU_SIZE = int(os.environ.get("CACHE_LRU_SIZE", 0))
+
+
+class LruCache(Cache):
+    """
+    Keeps recently used decoded entries of other cache in memory. Entries are shared
+    between callers, so they must not be modified
+    """
+
+    def __init__(
+        self,
+        cache: Cache,
+        maxsize: int,
+        getsizeof: typing.Callable[[typing.Any], int] = None,
+    ):
+        """
+        :param cache: wrapped cache
+        :param maxsize: maximum number of entries, or maximum total size if getsizeof
+        is provided
+        :param getsizeof: function returning size of entry, e.g. in bytes
+        """
+        self.cache = cache
+        self._lru = cachetools.LRUCache(maxsize, getsizeof=getsizeof)
+        self._lock = threading.Lock()
+        # changed by each modification, so entries read before it are not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, generation: int, values: typing.Dict[str, T]):
+        with self._lock:
+            if generation != self._generation:
+                return
+            for (name, value) in values.items():
+                try:
+                    self._lru[name] = value
+                except ValueError:
+                    # entry larger than whole cache
+                    pass
+
+    def get(self, name: str, default: T = None) -> typing.Optional[T]:
+        with self._lock:
+            try:
+                ret = self._lru[name]
+                self.hits += 1
+                return ret
+            except KeyError:
+                self.misses += 1
+                generation = self._generation
+        ret = self.cache.get(name)
+        if ret is None:
+            return default
+        self._store(generation, {name: ret})
+        return ret
+
+    def get_many(self, names: typing.Iterable[str]) -> typing.Dict[str, T]:
+        rv = {}
+        missing = []
+        with self._lock:
+            for name in names:
+                try:
+                    rv[name] = self._lru[name]
+                    self.hits += 1
+                except KeyError:
+                    missing.append(name)
+                    self.misses += 1
+            generation = self._generation
+        if missing:
+            values = self.cache.get_many(missing)
+            self._store(generation, values)
+            rv.update(values)
+        return rv
+
+    def _forget(self, name: str = None):
+        with self._lock:
+            self._generation += 1
+            if name is None:
+                self._lru.clear()
+            else:
+                self._lru.pop(name, None)
+
+    def add(self, name: str, value: T):
+        self.cache.add(name, value)
+        self._forget(name)
+
+    def delete(self, name: str):
+        self.cache.delete(name)
+        self._forget(name)
+
+    def reload(self, contents: typing.Dict[str, T]):
+        self.cache.reload(contents)
+        self._forget()
+
+    def iter_prefix(self, prefix: str) -> typing.Iterator[str]:
+        return self.cache.iter_prefix(prefix)
+
+    def reset_key_index(self):
+        self.cache.reset_key_index()
+
+    def invalidate(self):
+        self._forget()
+        self.cache.invalidate()
+
+    def keys(self):
+        return self.cache.keys()
+
+
 Version = typing.NewType("Version", int)
 DISABLE_UPDATE = bool(os.environ.get("DISABLE_UPDATE", ""))
+VERIFY_BATCH_SIZE = 1000  # number of keys fetched at once by VersionedCache.verify
 
 
 class VersionedCache(typing.Generic[T]):
@@ -141,6 +355,16 @@ class VersionedCache(typing.Generic[T]):
             self.path, serializer=self._get_serializer()
         )
 
+    def _get_cache_for_update(self, cache_version: Version) -> Cache[T]:
+        """
+        Returns cache without in-process LRU, as updates modify entries read from the
+        cache in place. LRU is cleared when new version is marked ready
+        """
+        cache = self._get_cache(cache_version)
+        if isinstance(cache, LruCache):
+            return cache.cache
+        return cache
+
     @synchronized
     def get_cache(self, allow_stale: bool = False, version: int = None) -> Cache[T]:
         if DISABLE_UPDATE:
@@ -180,17 +404,23 @@ class VersionedCache(typing.Generic[T]):
     def verify(self):
         cache = self._get_cache(cache_version=Version(-1))
         errors = 0
-        for key, value in tqdm.tqdm(
-            self._get_cache_data(self.file_cache_version()).items(), "Verifying cache"
-        ):
-            cache_entry = cache.get(key)
-            if not cache_entry == value:
-                self.__log.warning(
-                    "Elements doesn't match: (original) {} != {} (cache)".format(
-                        str(value), str(cache_entry)
-                    )
-                )
-                errors += 1
+        data = self._get_cache_data(self.file_cache_version())
+        keys = list(data.keys())
+        with tqdm.tqdm(total=len(keys), desc="Verifying cache") as progress:
+            for start in range(0, len(keys), VERIFY_BATCH_SIZE):
+                batch = keys[start : start + VERIFY_BATCH_SIZE]
+                cache_entries = cache.get_many(batch)
+                for key in batch:
+                    value = data[key]
+                    cache_entry = cache_entries.get(key)
+                    if not cache_entry == value:
+                        self.__log.warning(
+                            "Elements doesn't match: (original) {} != {} (cache)".format(
+                                str(value), str(cache_entry)
+                            )
+                        )
+                        errors += 1
+                progress.update(len(batch))
         if errors > 0:
             self.__log.error("Total mismatched elements: {}".format(errors))
             raise ValueError("Some elements didn't match")
@@ -198,6 +428,9 @@ class VersionedCache(typing.Generic[T]):
     def mark_ready(self, version: Version):
         get_cache_manager().mark_ready(self.path, version)
 
+    def create_snapshot(self):
+        create_snapshot(self.path, self._get_serializer())
+
 
 class CacheDriver:
     def get_table(self, name: str, serializer: Serializer = JsonSerializer()) -> Cache:
@@ -219,11 +452,17 @@ class MemoryCache(Cache):
     def get(self, name: str, default: dict = None) -> typing.Optional[dict]:
         return self.cache.get(name, default)
 
+    def get_many(self, names: typing.Iterable[str]) -> typing.Dict[str, dict]:
+        cache = self.cache
+        return {name: cache[name] for name in names if name in cache}
+
     def add(self, name: str, value: dict):
         self.cache[name] = value
+        self._index_add(name)
 
     def delete(self, name: str):
         del self.cache[name]
+        self._index_delete(name)
 
     def keys(self) -> typing.Iterable:
         return self.cache.keys()
@@ -263,25 +502,94 @@ class ShelveCache(Cache):
     def __init__(self, shlv: shelve.Shelf, serializer: Serializer):
         self.shelve = shlv
         self.serializer = serializer
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def _open(self, write: bool = False) -> typing.Iterator[shelve.Shelf]:
+        # shelve is not thread safe
+        with self._lock:
+            yield self.shelve
 
     def get(self, name: str, default: dict = None) -> typing.Optional[dict]:
-        ret = self.shelve.get(name)
+        with self._open() as shlv:
+            ret = shlv.get(name)
         if ret:
             return self.serializer.deserialize(ret)
         if not ret and default:
             return default
         return None
 
+    def get_many(self, names: typing.Iterable[str]) -> typing.Dict[str, dict]:
+        return dict(
+            (name, self.serializer.deserialize(value))
+            for (name, value) in self.get_many_serialized(names).items()
+        )
+
+    def get_many_serialized(
+        self, names: typing.Iterable[str], serializer: Serializer = None
+    ) -> typing.Dict[str, bytes]:
+        rv = {}
+        with self._open() as shlv:
+            for name in names:
+                # Shelf.get checks for the key before reading it, read it once
+                try:
+                    ret = shlv[name]
+                except KeyError:
+                    continue
+                if ret:
+                    rv[name] = ret
+        return rv
+
     def add(self, name: str, value: dict):
-        self.shelve[name] = self.serializer.serialize(value)
+        with self._open(write=True) as shlv:
+            shlv[name] = self.serializer.serialize(value)
+        self._index_add(name)
 
     def delete(self, name: str):
-        del self.shelve[name]
+        with self._open(write=True) as shlv:
+            del shlv[name]
+        self._index_delete(name)
 
     def keys(self) -> typing.Iterable:
         return self.shelve.keys()
 
 
+SHELVE_OPEN_RETRIES = 5  # attempts to open shelve file locked by another process
+
+
+class ShelveFileCache(ShelveCache):
+    """
+    Shelve cache that opens the file only for each operation, so other processes,
+    e.g. other gunicorn workers, can use it in between
+    """
+
+    def __init__(self, path: str, serializer: Serializer):
+        self.path = path
+        self.serializer = serializer
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def _open(self, write: bool = False) -> typing.Iterator[shelve.Shelf]:
+        with self._lock:
+            for attempt in range(1, SHELVE_OPEN_RETRIES + 1):
+                try:
+                    shlv = shelve.open(self.path, flag="c" if write else "r")
+                    break
+                except dbm.error:
+                    if attempt == SHELVE_OPEN_RETRIES:
+                        raise
+                    # other process holds the lock, wait until it finishes
+                    time.sleep(0.05 * 2 ** attempt)
+            try:
+                yield shlv
+            finally:
+                shlv.close()
+
+    def keys(self) -> typing.Iterable:
+        with self._open() as shlv:
+            return list(shlv.keys())
+
+
 class ShelveCacheDriver(CacheDriver):
     def __init__(self):
         self.directory = os.path.join(tempfile.gettempdir(), "osm_cache")
@@ -307,8 +615,366 @@ class ShelveCacheDriver(CacheDriver):
     def get_or_create(
         self, name: str, serializer: Serializer = JsonSerializer()
     ) -> ShelveCache:
-        ret = shelve.open(os.path.join(self.directory, name), flag="c")
-        return ShelveCache(ret, serializer)
+        path = os.path.join(self.directory, name)
+        # create the file, so it can be opened read only later on
+        shelve.open(path, flag="c").close()
+        return ShelveFileCache(path, serializer)
+
+
+SQLITE_BATCH_GET_SIZE = 500  # below default limit of 999 parameters in a query
+SQLITE_TIMEOUT = 30  # seconds to wait for other process writing to the database
+
+
+class SqliteCache(Cache):
+    """
+    Cache kept in SQLite database in WAL mode, so many processes may read it while
+    it is being written. Connection is reopened after fork, as it may not be shared
+    between processes
+    """
+
+    def __init__(self, path: str, serializer: Serializer, read_only: bool = False):
+        self.path = path
+        self.serializer = serializer
+        self.read_only = read_only
+        self._lock = threading.RLock()
+        self._pid = None
+        self._connection = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._pid == os.getpid():
+            return self._connection
+        # check_same_thread is off, as access is guarded by self._lock
+        if self.read_only:
+            # WAL mode and the table are set up by the writer
+            connection = sqlite3.connect(
+                "file:{0}?mode=ro".format(urllib.request.pathname2url(self.path)),
+                uri=True,
+                timeout=SQLITE_TIMEOUT,
+                check_same_thread=False,
+            )
+        else:
+            connection = sqlite3.connect(
+                self.path, timeout=SQLITE_TIMEOUT, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB) "
+                "WITHOUT ROWID"
+            )
+            connection.commit()
+        self._connection = connection
+        self._pid = os.getpid()
+        return self._connection
+
+    def get(self, name: str, default: dict = None) -> typing.Optional[dict]:
+        with self._lock:
+            ret = (
+                self._get_connection()
+                .execute("SELECT value FROM cache WHERE key = ?", (name,))
+                .fetchone()
+            )
+        if ret and ret[0]:
+            return self.serializer.deserialize(ret[0])
+        if default:
+            return default
+        return None
+
+    def get_many(self, names: typing.Iterable[str]) -> typing.Dict[str, dict]:
+        return dict(
+            (name, self.serializer.deserialize(value))
+            for (name, value) in self.get_many_serialized(names).items()
+        )
+
+    def get_many_serialized(
+        self, names: typing.Iterable[str], serializer: Serializer = None
+    ) -> typing.Dict[str, bytes]:
+        keys = list(dict.fromkeys(names))
+        rv = {}
+        for start in range(0, len(keys), SQLITE_BATCH_GET_SIZE):
+            batch = keys[start : start + SQLITE_BATCH_GET_SIZE]
+            with self._lock:
+                rows = (
+                    self._get_connection()
+                    .execute(
+                        "SELECT key, value FROM cache WHERE key IN ({0})".format(
+                            ", ".join("?" * len(batch))
+                        ),
+                        batch,
+                    )
+                    .fetchall()
+                )
+            for (key, value) in rows:
+                if value:
+                    rv[key] = value
+        return rv
+
+    def add(self, name: str, value: dict):
+        with self._lock:
+            connection = self._get_connection()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                    (name, self.serializer.serialize(value)),
+                )
+
+    def delete(self, name: str):
+        with self._lock:
+            connection = self._get_connection()
+            with connection:
+                ret = connection.execute("DELETE FROM cache WHERE key = ?", (name,))
+        if not ret.rowcount:
+            raise KeyError(name)
+
+    def clear(self):
+        with self._lock:
+            connection = self._get_connection()
+            with connection:
+                connection.execute("DELETE FROM cache")
+
+    @synchronized
+    def reload(self, contents: typing.Dict[str, T]):
+        # one transaction for all the entries
+        with self._lock:
+            connection = self._get_connection()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                    (
+                        (key, self.serializer.serialize(value))
+                        for (key, value) in tqdm.tqdm(
+                            contents.items(), desc="Reloading cache"
+                        )
+                    ),
+                )
+
+    def iter_prefix(self, prefix: str) -> typing.Iterator[str]:
+        # range query on primary key index
+        if prefix:
+            query = "SELECT key FROM cache WHERE key >= ? AND key < ? ORDER BY key"
+            args = (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        else:
+            query = "SELECT key FROM cache ORDER BY key"
+            args = ()
+        with self._lock:
+            rows = self._get_connection().execute(query, args).fetchall()
+        return (x[0] for x in rows)
+
+    def reset_key_index(self):
+        pass
+
+    def keys(self) -> typing.Iterable:
+        return self.iter_prefix("")
+
+
+class SqliteCacheDriver(CacheDriver):
+    def __init__(self):
+        self.directory = os.path.join(tempfile.gettempdir(), "osm_cache")
+        os.makedirs(self.directory, mode=0o755, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name + ".sqlite")
+
+    def get_table(
+        self, name: str, serializer: Serializer = JsonSerializer()
+    ) -> SqliteCache:
+        if not os.path.exists(self._path(name)):
+            raise CacheNotInitialized(name)
+        return SqliteCache(self._path(name), serializer, read_only=DISABLE_UPDATE)
+
+    def create(
+        self, name: str, serializer: Serializer = JsonSerializer()
+    ) -> SqliteCache:
+        ret = SqliteCache(self._path(name), serializer)
+        ret.clear()
+        return ret
+
+    def get_or_create(
+        self, name: str, serializer: Serializer = JsonSerializer()
+    ) -> SqliteCache:
+        return SqliteCache(self._path(name), serializer)
+
+
+SNAPSHOT_DIRECTORY = os.path.join(tempfile.gettempdir(), "osm_cache")
+SNAPSHOT_MAGIC = b"OSMSNAP2"
+SNAPSHOT_BATCH_SIZE = 1000  # number of entries read at once from source cache
+# magic, number of entries, version of the cache
+_SNAPSHOT_HEADER = struct.Struct("!8sQq")
+# key offset, key length, value offset, value length
+_SNAPSHOT_ENTRY = struct.Struct("!QIQI")
+
+
+def snapshot_path(name: str) -> str:
+    return os.path.join(SNAPSHOT_DIRECTORY, name + ".snapshot")
+
+
+def write_snapshot(
+    path: str,
+    keys: typing.List[str],
+    get_values: typing.Callable[[typing.List[str]], typing.Dict[str, bytes]],
+    version: int = -1,
+) -> None:
+    """
+    Writes snapshot file: header, table of entries sorted by key and then keys and
+    values. File is replaced atomically, so processes that still map the old file
+    are not affected
+
+    :param path: snapshot file name
+    :param keys: all keys of the cache
+    :param get_values: function returning dict of serialized values for list of keys
+    :param version: version of the cache contents
+    """
+    encoded = sorted((x.encode("utf-8"), x) for x in set(keys))
+    offset = _SNAPSHOT_HEADER.size + _SNAPSHOT_ENTRY.size * len(encoded)
+    entries = []
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.seek(offset)
+        for start in tqdm.tqdm(
+            range(0, len(encoded), SNAPSHOT_BATCH_SIZE), desc="Writing snapshot"
+        ):
+            batch = encoded[start : start + SNAPSHOT_BATCH_SIZE]
+            values = get_values([x[1] for x in batch])
+            for (key, name) in batch:
+                value = values.get(name, b"")
+                entries.append(
+                    _SNAPSHOT_ENTRY.pack(
+                        offset, len(key), offset + len(key), len(value)
+                    )
+                )
+                f.write(key)
+                f.write(value)
+                offset += len(key) + len(value)
+        f.seek(0)
+        f.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(entries), version))
+        f.write(b"".join(entries))
+    os.replace(tmp_path, path)
+
+
+def create_snapshot(name: str, serializer: Serializer = JsonSerializer()) -> None:
+    """
+    Creates snapshot of the cache from the current cache driver, with cache version
+    from metadata
+    """
+    manager = get_cache_manager()
+    driver = manager.cache_driver
+    if isinstance(driver, SnapshotCacheDriver):
+        driver = driver.fallback
+    cache = driver.get_table(name, serializer)
+    write_snapshot(
+        snapshot_path(name),
+        list(cache.keys()),
+        # stored values are copied without decoding them
+        functools.partial(cache.get_many_serialized, serializer=serializer),
+        manager.version(name),
+    )
+
+
+class SnapshotCache(Cache):
+    """
+    Read-only cache memory-mapped from snapshot file. Pages are shared through page
+    cache by all processes and keys are found by binary search of sorted entries
+    """
+
+    def __init__(self, path: str, serializer: Serializer):
+        self.path = path
+        self.serializer = serializer
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self._count, self.version) = _SNAPSHOT_HEADER.unpack_from(
+            self._mmap, 0
+        )
+        if magic != SNAPSHOT_MAGIC:
+            raise CacheError("Not a cache snapshot: {0}".format(path))
+
+    def _entry(self, position: int) -> typing.Tuple[int, int, int, int]:
+        return _SNAPSHOT_ENTRY.unpack_from(
+            self._mmap, _SNAPSHOT_HEADER.size + _SNAPSHOT_ENTRY.size * position
+        )
+
+    def _key(self, position: int) -> bytes:
+        (key_offset, key_length, _, _) = self._entry(position)
+        return self._mmap[key_offset : key_offset + key_length]
+
+    def _lower_bound(self, key: bytes) -> int:
+        (low, high) = (0, self._count)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, name: str, default: dict = None) -> typing.Optional[dict]:
+        key = name.encode("utf-8")
+        position = self._lower_bound(key)
+        if position < self._count:
+            (key_offset, key_length, value_offset, value_length) = self._entry(position)
+            if self._mmap[key_offset : key_offset + key_length] == key and value_length:
+                return self.serializer.deserialize(
+                    self._mmap[value_offset : value_offset + value_length]
+                )
+        if default:
+            return default
+        return None
+
+    def add(self, name: str, value: dict):
+        raise CacheError("Cache snapshot is read-only: {0}".format(self.path))
+
+    def delete(self, name: str):
+        raise CacheError("Cache snapshot is read-only: {0}".format(self.path))
+
+    def reload(self, contents: typing.Dict[str, T]):
+        raise CacheError("Cache snapshot is read-only: {0}".format(self.path))
+
+    def iter_prefix(self, prefix: str) -> typing.Iterator[str]:
+        key = prefix.encode("utf-8")
+        position = self._lower_bound(key)
+        while position < self._count:
+            value = self._key(position)
+            if not value.startswith(key):
+                break
+            yield value.decode("utf-8")
+            position += 1
+
+    def reset_key_index(self):
+        pass
+
+    def keys(self) -> typing.Iterable:
+        return (self._key(x).decode("utf-8") for x in range(self._count))
+
+
+class SnapshotCacheDriver(CacheDriver):
+    """
+    Serves caches that have a snapshot file from the snapshot, and all the others
+    from fallback driver
+    """
+
+    def __init__(self, fallback: CacheDriver):
+        self.fallback = fallback
+
+    def get_table(self, name: str, serializer: Serializer = JsonSerializer()) -> Cache:
+        path = snapshot_path(name)
+        if os.path.exists(path):
+            return SnapshotCache(path, serializer)
+        return self.fallback.get_table(name, serializer)
+
+    def create(self, name: str, serializer: Serializer = JsonSerializer()) -> Cache:
+        # snapshot will be outdated by new cache contents
+        if os.path.exists(snapshot_path(name)):
+            os.remove(snapshot_path(name))
+        return self.fallback.create(name, serializer)
+
+    def get_or_create(
+        self, name: str, serializer: Serializer = JsonSerializer()
+    ) -> Cache:
+        return self.fallback.get_or_create(name, serializer)
+
+
+DYNAMO_BATCH_GET_SIZE = 100  # limit of keys in one batch_get_item
+DYNAMO_BATCH_GET_ATTEMPTS = 10  # calls of batch_get_item for one chunk of keys
+DYNAMO_MAX_ITEM_SIZE = 400 * 1024  # limit of item size, including attribute names
 
 
 class DynamoCache(Cache):
@@ -329,16 +995,70 @@ class DynamoCache(Cache):
             return default
         return None
 
-    def add(self, name: str, value: dict):
-        self._table.put_item(
-            Item={"key": name, "value": self.serializer.serialize(value)}
+    def get_many(self, names: typing.Iterable[str]) -> typing.Dict[str, dict]:
+        return dict(
+            (name, self.serializer.deserialize(value))
+            for (name, value) in self.get_many_serialized(names).items()
+        )
+
+    def get_many_serialized(
+        self, names: typing.Iterable[str], serializer: Serializer = None
+    ) -> typing.Dict[str, bytes]:
+        keys = list(dict.fromkeys(names))
+        self._logger.info(
+            "Accessing %d keys from table: %s", len(keys), self._table.name
         )
+        client = self._table.meta.client
+        rv = {}
+        for start in range(0, len(keys), DYNAMO_BATCH_GET_SIZE):
+            request = {
+                self._table.name: {
+                    "Keys": [
+                        {"key": {"S": x}}
+                        for x in keys[start : start + DYNAMO_BATCH_GET_SIZE]
+                    ]
+                }
+            }
+            attempt = 0
+            while request:
+                if attempt == DYNAMO_BATCH_GET_ATTEMPTS:
+                    raise CacheError(
+                        "Keys from table {0} still unprocessed after {1} attempts".format(
+                            self._table.name, attempt
+                        )
+                    )
+                if attempt:
+                    # throttled, back off before asking for the rest
+                    time.sleep(min(0.05 * 2 ** attempt, 2))
+                ret = client.batch_get_item(RequestItems=request)
+                for item in ret["Responses"].get(self._table.name, []):
+                    value = item["value"]["B"]
+                    if value:
+                        rv[item["key"]["S"]] = value
+                request = ret.get("UnprocessedKeys")
+                attempt += 1
+        return rv
+
+    def add(self, name: str, value: dict):
+        data = self.serializer.serialize(value)
+        size = len("key") + len(name.encode("utf-8")) + len("value") + len(data)
+        if size > DYNAMO_MAX_ITEM_SIZE:
+            raise CacheError(
+                "Entry {0} of {1} bytes exceeds DynamoDB item size limit of {2} "
+                "bytes, not stored in table {3}".format(
+                    name, size, DYNAMO_MAX_ITEM_SIZE, self._table.name
+                )
+            )
+        self._table.put_item(Item={"key": name, "value": data})
+        self._index_add(name)
 
     def delete(self, name: str):
         self._table.delete_item(Key={"key": name})
+        self._index_delete(name)
 
     @synchronized
     def reload(self, contents: dict):
+        index = self._key_index
         old_capacity = self._table.provisioned_throughput["WriteCapacityUnits"]
         try:
             if old_capacity < 10:
@@ -356,6 +1076,7 @@ class DynamoCache(Cache):
                 self._set_write_capacity(old_capacity)
             except botocore.exceptions.ClientError:
                 pass
+        self._index_reload(index, contents.keys())
 
     def _set_write_capacity(self, capacity):
         self._table.meta.client.update_table(
@@ -369,13 +1090,19 @@ class DynamoCache(Cache):
         )
 
     def keys(self) -> typing.Iterable:
-        ret = self._table.scan(
-            ProjectionExpression="#k", ExpressionAttributeNames={"#k": "key"}
-        )
-        return (x["key"] for x in ret["Items"])
+        kwargs = dict(ProjectionExpression="#k", ExpressionAttributeNames={"#k": "key"})
+        while True:
+            ret = self._table.scan(**kwargs)
+            yield from (x["key"] for x in ret["Items"])
+            # scan returns at most 1MB of data at once
+            if "LastEvaluatedKey" not in ret:
+                break
+            kwargs["ExclusiveStartKey"] = ret["LastEvaluatedKey"]
 
 
 class DynamoCacheDriver(CacheDriver):
+    __log = logging.getLogger(__name__)
+
     def __init__(self, dynamodb):
         self.dynamodb = dynamodb
 
@@ -422,12 +1149,31 @@ class DynamoCacheDriver(CacheDriver):
     def get_or_create(
         self, name: str, serializer: Serializer = JsonSerializer()
     ) -> DynamoCache:
-        ret = self.dynamodb.Table(name)
-        # self.dynamodb.meta.client.describe_table(TableName=name)['Table']
-        return DynamoCache(ret, serializer)
+        client = self.dynamodb.meta.client
+        try:
+            client.describe_table(TableName=name)
+        except client.exceptions.ResourceNotFoundException:
+            self.__log.info("Creating DynamoDB table %s", name)
+            try:
+                # billed per request, as writes of unversioned caches come in bursts
+                client.create_table(
+                    TableName=name,
+                    AttributeDefinitions=[
+                        {"AttributeName": "key", "AttributeType": "S"}
+                    ],
+                    KeySchema=[{"AttributeName": "key", "KeyType": "HASH"}],
+                    BillingMode="PAY_PER_REQUEST",
+                )
+            except client.exceptions.ResourceInUseException:
+                # created by other process in the meantime
+                pass
+            client.get_waiter("table_exists").wait(TableName=name)
+        return DynamoCache(self.dynamodb.Table(name), serializer)
 
 
 class CacheManager(object):
+    __log = logging.getLogger(__name__)
+
     def __init__(self, cache_driver: CacheDriver):
         self.cache_driver = cache_driver
         meta = self.cache_driver.get_or_create("meta")
@@ -456,7 +1202,20 @@ class CacheManager(object):
             raise CacheNotInitialized(name)
 
         ret = self.cache_driver.get_table(name, serializer)
-        if (version and cache["version"] >= version) or not version or version < 0:
+        if not DISABLE_UPDATE:
+            ret.version_getter = functools.partial(self.version, name)
+        cache_version = cache["version"]
+        if isinstance(ret, SnapshotCache) and ret.version != cache_version:
+            self.__log.warning(
+                "Snapshot of cache %s has version %s, but cache has version %s",
+                name,
+                ret.version,
+                cache_version,
+            )
+            cache_version = ret.version
+        if (version and cache_version >= version) or not version or version < 0:
+            if CACHE_LRU_SIZE:
+                ret = LruCache(ret, CACHE_LRU_SIZE)
             self.open_caches[name] = ret
             return ret
 
@@ -466,6 +1225,20 @@ class CacheManager(object):
             )
         )
 
+    def get_or_create_cache(
+        self, name: str, serializer: Serializer = JsonSerializer()
+    ) -> Cache:
+        """
+        Returns cache that is neither versioned nor tracked in metadata, e.g. for data
+        with its own expiry
+        """
+        if name == "meta":
+            raise ValueError("Forbidden cache name: meta")
+
+        if name not in self.open_caches:
+            self.open_caches[name] = self.cache_driver.get_or_create(name, serializer)
+        return self.open_caches[name]
+
     def create_cache(
         self, name: str, serializer: Serializer = JsonSerializer()
     ) -> Cache:
@@ -476,6 +1249,9 @@ class CacheManager(object):
         return self.cache_driver.create(name, serializer)
 
     def mark_ready(self, name: str, version: int):
+        if name in self.open_caches:
+            # contents may have been loaded through other instance
+            self.open_caches[name].invalidate()
         desc = self.meta.get(name)
         desc["status"] = "ready"
         desc["updated"] = time.time()
@@ -483,7 +1259,8 @@ class CacheManager(object):
         self.meta.add(name, desc)
 
     def version(self, name: str):
-        return self.meta.get(name, {}).get("version", -1)
+        # drivers other than memory return None instead of empty default
+        return (self.meta.get(name) or {}).get("version", -1)
 
 
 if os.environ.get("USE_AWS"):
@@ -492,11 +1269,19 @@ if os.environ.get("USE_AWS"):
 
     config = Config(retries=dict(max_attempts=20))
 
-    __cache_manager = CacheManager(
-        DynamoCacheDriver(boto3.resource("dynamodb", config=config))
-    )
+    __cache_driver = DynamoCacheDriver(boto3.resource("dynamodb", config=config))
+elif os.environ.get("USE_SQLITE"):
+    __cache_driver = SqliteCacheDriver()
 else:
-    __cache_manager = CacheManager(ShelveCacheDriver())
+    __cache_driver = ShelveCacheDriver()
+
+if os.environ.get("USE_SNAPSHOTS"):
+    if not DISABLE_UPDATE:
+        # snapshots are read-only, so VersionedCache can't update them
+        raise ValueError("USE_SNAPSHOTS requires DISABLE_UPDATE")
+    __cache_driver = SnapshotCacheDriver(__cache_driver)
+
+__cache_manager = CacheManager(__cache_driver)
 
 
 def get_cache_manager():
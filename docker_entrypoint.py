@@ -11,21 +11,23 @@ __log = logging.getLogger(__name__)
 
 
 def get_all_borders(terc):
-    return borders.borders.get_borders(terc)
+    return borders.borders.get_borders_converter(terc)
 
 
 def get_nosplit_borders(terc):
-    return borders.borders.get_borders(
+    return borders.borders.get_borders_converter(
         terc, borders_mapping=lambda x: x, do_clean_borders=False
     )
 
 
 def get_lvl8_borders(terc):
-    return borders.borders.get_borders(terc, lambda x: x.tags.get("admin_level") == "8")
+    return borders.borders.get_borders_converter(
+        terc, lambda x: x.tags.get("admin_level") == "8"
+    )
 
 
 def get_gminy(terc):
-    return borders.borders.gminy_prg_as_osm(terc)
+    return borders.borders.gminy_prg_converter(terc)
 
 
 def main():
@@ -83,19 +85,19 @@ def main():
     __log.info("Working with {0} {1}".format(teryt_entry.rodz_nazwa, teryt_entry.nazwa))
 
     if args.mode == "all_borders":
-        data = get_all_borders(terc)
+        converter = get_all_borders(terc)
     elif args.mode == "nosplit_borders":
-        data = get_nosplit_borders(terc)
+        converter = get_nosplit_borders(terc)
     elif args.mode == "only_lvl8":
-        data = get_lvl8_borders(terc)
+        converter = get_lvl8_borders(terc)
     elif args.mode == "prg":
-        data = get_gminy(terc)
+        converter = get_gminy(terc)
     else:
         raise ValueError("Unknown mode: {0}".format(args.mode))
 
     with args.output if args.output else open("{0}.osm".format(terc), "w+b") as output:
-        output.write(data)
-        __log.info("Wrote {0} bytes to {1}".format(len(data), output.name))
+        size = converter.write(output)
+        __log.info("Wrote {0} bytes to {1}".format(size, output.name))
 
 
 if __name__ == "__main__":
@@ -1,15 +1,32 @@
 import argparse
+import functools
 import logging
 
-from borders.borders import get_borders
+import borders.formats
+from borders.borders import get_borders_converter
+from borders.geoutils import (
+    split_by_common_ways,
+    split_by_components,
+    split_by_topology,
+)
+
+BORDERS_MAPPINGS = {"pairwise": split_by_common_ways, "topology": split_by_topology}
 
 
 def fetch(args):
-    args.output.write(
-        get_borders(
-            args.terc[0], filter_func=lambda x: x.tags.get("admin_level") == "8"
-        )
+    output_format = (
+        args.format or borders.formats.format_from_filename(args.output.name) or "osm"
+    )
+    converter = get_borders_converter(
+        args.terc[0],
+        filter_func=lambda x: x.tags.get("admin_level") == "8",
+        borders_mapping=functools.partial(
+            split_by_components,
+            borders_mapping=BORDERS_MAPPINGS[args.mode],
+            max_workers=args.workers,
+        ),
     )
+    borders.formats.write(converter, args.output, output_format)
 
 
 def init(args):
@@ -44,6 +61,31 @@ def main():
         help="output file with merged data (default: result.osm)",
     )
 
+    fetch_parser.add_argument(
+        "--format",
+        choices=sorted(borders.formats.OUTPUT_FORMATS.keys()),
+        default=None,
+        help="output file format, default: based on output file extension, osm if "
+        "extension is not known",
+    )
+
+    fetch_parser.add_argument(
+        "--mode",
+        choices=sorted(BORDERS_MAPPINGS.keys()),
+        default="pairwise",
+        help="how common ways are found: pairwise - intersect each pair of borders, "
+        "topology - node all borders at once (faster for big municipalities), "
+        "default: pairwise",
+    )
+
+    fetch_parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of processes used to split borders, default: SPLIT_WORKERS "
+        "environment variable or number of CPUs",
+    )
+
     fetch_parser.add_argument("terc", nargs=1, help="county terc code")
     fetch_parser.set_defaults(func=fetch)
 
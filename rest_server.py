@@ -1,11 +1,14 @@
+import itertools
 import logging
 import os
 from xml.sax.saxutils import quoteattr
 
-from flask import Flask, make_response as _make_response
-from flask import request, redirect, url_for, render_template
+from flask import Flask, Response, make_response as _make_response
+from flask import abort, request, redirect, url_for, render_template
+from werkzeug.routing import BaseConverter
 
 import borders.borders
+import borders.formats
 from converters import teryt
 
 PRG_GMINY_CACHE_V_ = "osm_prg_gminy_cache_v1"
@@ -16,29 +19,71 @@ logger.info("Working in standard rest-server mode")
 app = Flask(__name__)
 
 
+class TercConverter(BaseConverter):
+    # only digits, so the rest of file name is left for extension
+    regex = "[0-9]+"
+
+
+app.url_map.converters["terc"] = TercConverter
+
+
 def make_response(ret, code):
     resp = _make_response(ret, code)
     resp.mimetype = "text/xml; charset=utf-8"
     return resp
 
 
-@app.route("/osm-borders/all/<terc>.osm", methods=["GET"])
-def get_all_borders(*, terc):
-    resp = make_response(borders.borders.get_borders(terc), 200)
-    resp.headers["Content-Disposition"] = "attachment; filename={0}.osm".format(terc)
+def select_format(extension: str) -> str:
+    """
+    Returns output format for requested file extension. For .osm files, Accept header
+    may select other format
+    """
+    output_format = borders.formats.format_from_filename("." + extension)
+    if output_format is None:
+        abort(404)
+    if output_format == "osm":
+        mimetype = request.accept_mimetypes.best_match(
+            [x.mimetype.split(";")[0] for x in borders.formats.OUTPUT_FORMATS.values()],
+            default="text/xml",
+        )
+        output_format = borders.formats.format_from_mimetype(mimetype)
+    return output_format
+
+
+def make_streaming_response(
+    converter: borders.borders.FeatureToOsm, output_format: str, name: str
+):
+    fmt = borders.formats.OUTPUT_FORMATS[output_format]
+    chunks = iter(fmt.iter_chunks(converter))
+    # first part is converted before response starts, so errors are still reported
+    # by error handlers
+    first = next(chunks)
+    resp = Response(itertools.chain([first], chunks), 200, mimetype=fmt.mimetype)
+    resp.headers["Content-Disposition"] = "attachment; filename={0}.{1}".format(
+        name, fmt.extension
+    )
+    resp.vary.add("Accept")
     return resp
 
 
-@app.route("/osm-borders/nosplit/<terc>.osm", methods=["GET"])
-def get_nosplit_borders(*, terc):
-    resp = make_response(
-        borders.borders.get_borders(
+@app.route("/osm-borders/all/<terc:terc>.<extension>", methods=["GET"])
+def get_all_borders(*, terc, extension):
+    output_format = select_format(extension)
+    return make_streaming_response(
+        borders.borders.get_borders_converter(terc), output_format, terc
+    )
+
+
+@app.route("/osm-borders/nosplit/<terc:terc>.<extension>", methods=["GET"])
+def get_nosplit_borders(*, terc, extension):
+    output_format = select_format(extension)
+    return make_streaming_response(
+        borders.borders.get_borders_converter(
             terc, borders_mapping=lambda x: x, do_clean_borders=False
         ),
-        200,
+        output_format,
+        terc,
     )
-    resp.headers["Content-Disposition"] = "attachment; filename={0}.osm".format(terc)
-    return resp
 
 
 @app.route("/osm-borders/error<stuff>", methods=["GET"])
@@ -46,21 +91,26 @@ def error(stuff):
     raise ValueError("Sample error")
 
 
-@app.route("/osm-borders/<terc>.osm", methods=["GET"])
-def get_lvl8_borders(*, terc):
-    brd = borders.borders.get_borders(terc, lambda x: x.tags.get("admin_level") == "8")
-    resp = make_response(brd, 200)
-    resp.headers["Content-Disposition"] = "attachment; filename={0}.osm".format(terc)
-    return resp
+@app.route("/osm-borders/<terc:terc>.<extension>", methods=["GET"])
+def get_lvl8_borders(*, terc, extension):
+    output_format = select_format(extension)
+    return make_streaming_response(
+        borders.borders.get_borders_converter(
+            terc, lambda x: x.tags.get("admin_level") == "8"
+        ),
+        output_format,
+        terc,
+    )
 
 
-@app.route("/osm-borders/prg/gminy/<terc>.osm", methods=["GET"])
-def get_gminy(*, terc):
-    resp = make_response(borders.borders.gminy_prg_as_osm(terc), 200)
-    resp.headers["Content-Disposition"] = "attachment; filename={0}-gminy.osm".format(
-        terc
+@app.route("/osm-borders/prg/gminy/<terc:terc>.<extension>", methods=["GET"])
+def get_gminy(*, terc, extension):
+    output_format = select_format(extension)
+    return make_streaming_response(
+        borders.borders.gminy_prg_converter(terc),
+        output_format,
+        "{0}-gminy".format(terc),
     )
-    return resp
 
 
 @app.errorhandler(404)
@@ -80,18 +130,17 @@ def list_all():
 def render_list(terc):
     teryt_cache = teryt.teryt()
     if terc:
-        items = [
-            (k, teryt_cache[k])
-            for k in teryt_cache.keys()
-            if k.startswith(terc) and len(k) > len(terc)
-        ]
-        # items = [(k, v) for k, v in teryt.teryt().keys() if k.startswith(terc) and len(k) > len(terc)]
+        keys = [k for k in teryt_cache.iter_prefix(terc) if len(k) > len(terc)]
     else:
-        items = [(k, teryt_cache[k]) for k in teryt_cache.keys() if len(k) < 7]
-        # items = [(k, v) for k, v in teryt.teryt().keys() if len(k) < 7]
-    resp = make_response(
-        render_template("list.html", items=items, teryt=teryt.teryt()), 200
+        keys = [k for k in teryt_cache.iter_prefix("") if len(k) < 7]
+    values = teryt_cache.get_many(keys)
+    items = [(k, values[k]) for k in keys if k in values]
+    # names of wojewodztwo and powiat shown for each item
+    parents = teryt_cache.get_many(
+        set(v.woj for v in values.values())
+        | set(v.woj + v.powiat for v in values.values() if v.powiat)
     )
+    resp = make_response(render_template("list.html", items=items, teryt=parents), 200)
     resp.mimetype = "text/html"
     return resp
 
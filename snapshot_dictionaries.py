@@ -0,0 +1,15 @@
+import logging
+
+import converters.teryt
+import converters.prg
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    converters.teryt.snapshot()
+    converters.prg.snapshot()
+
+
+if __name__ == "__main__":
+    main()
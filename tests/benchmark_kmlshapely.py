@@ -0,0 +1,35 @@
+"""
+Compares parsers of placemark descriptions on KML files in this directory.
+Run from tests directory: PYTHONPATH=.. python benchmark_kmlshapely.py
+"""
+import glob
+import timeit
+import xml.etree.ElementTree
+
+import converters.kmlshapely
+
+
+def main():
+    descriptions = []
+    for name in sorted(glob.glob("*.kml")):
+        with open(name) as f:
+            tree = xml.etree.ElementTree.fromstring(f.read())
+        descriptions.extend(
+            x.text for x in tree.iter(converters.kmlshapely.ns + "description")
+        )
+    print("{0} placemarks".format(len(descriptions)))
+    baseline = None
+    for (name, parser) in converters.kmlshapely.DESCRIPTION_PARSERS.items():
+        elapsed = min(
+            timeit.repeat(lambda: [parser(x) for x in descriptions], number=1, repeat=3)
+        )
+        baseline = baseline or elapsed
+        print(
+            "{0:>5}: {1:.3f}s, {2:.1f}x faster than bs4".format(
+                name, elapsed, baseline / elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,21 @@
 import itertools
 import json
 import logging
+import threading
+import time
 import unittest
+import unittest.mock
 
+import lz4.frame
 import overpy
+import requests
 import shapely.geometry
 
 import borders.borders
 import borders.geoutils
 import borders.wikidata
 import converters.feature
+import converters.tools
 from borders.geoutils import split_intersec
 from converters.kmlshapely import kml_to_shapely
 from converters.overpyshapely import OverToShape
@@ -17,6 +23,38 @@ from converters.overpyshapely import OverToShape
 logging.basicConfig(level=logging.INFO)
 
 
+class FakeEmuiaResponse:
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeEmuiaSession:
+    """
+    Returns responses, or raises exceptions, in the given order
+    """
+
+    def __init__(self, responses: list):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url: str, **kwargs):
+        self.requests.append(kwargs["params"]["BBOX"])
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
 class BorderTests(unittest.TestCase):
     def test_process(self):
         # res = overpy.Overpass().query("[out:json];relation(3094349);out;>;out;")#.get_relation(3094349)
@@ -321,6 +359,510 @@ class BorderTests(unittest.TestCase):
             shapely.geometry.LineString([(1, 1), (1, 0)]) in list(rv[2].geometry.geoms)
         )
 
+    def test_candidate_pairs(self):
+        # left and right touch each other, far is away from both
+        left = shapely.geometry.LineString([(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)])
+        right = shapely.geometry.LineString([(1, 1), (1, 0), (2, 0), (2, 1), (1, 1)])
+        far = shapely.geometry.LineString([(5, 5), (5, 6), (6, 6), (6, 5), (5, 5)])
+        self.assertEqual([(0, 1)], borders.geoutils.candidate_pairs([left, right, far]))
+        self.assertEqual([(0, 2)], borders.geoutils.candidate_pairs([left, far, right]))
+
+    def test_topology_one_line(self):
+        # two boxes - left and right
+        # (0,1)---(1,1)---(2,1)
+        #   |       |       |
+        # (0,0)---(1,0)---(2,0)
+        left = converters.feature.Feature(
+            shapely.geometry.LineString([(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)])
+        )
+        right = converters.feature.Feature(
+            shapely.geometry.LineString([(1, 1), (1, 0), (2, 0), (2, 1), (1, 1)])
+        )
+        rv = borders.geoutils.split_by_topology([left, right])
+        self.assertEqual(len(rv[0].geometry.geoms), 2)
+        self.assertEqual(len(rv[1].geometry.geoms), 2)
+        common = shapely.geometry.LineString([(1, 1), (1, 0)])
+        self.assertTrue(common in list(rv[0].geometry.geoms))
+        self.assertTrue(common in list(rv[1].geometry.geoms))
+
+    def test_topology_extra_point(self):
+        # 2 boxes exactly the same with extra point along the line
+        border1 = converters.feature.Feature(
+            shapely.geometry.LineString([(0, 0), (0, 2), (2, 2), (2, 0), (0, 0)])
+        )
+        border2 = converters.feature.Feature(
+            shapely.geometry.LineString(
+                [(0, 1), (0, 2), (2, 2), (2, 0), (0, 0), (0, 1)]
+            )
+        )
+        rv = borders.geoutils.split_by_topology([border1, border2])
+        self.assertEqual(len(rv[0].geometry.geoms), 1)
+        self.assertEqual(list(rv[0].geometry.geoms), list(rv[1].geometry.geoms))
+
+    def test_topology_moved_edge(self):
+        # two triangles sharing a skewed line, the noded line is not exactly on any
+        # of the inputs, so it is further than tolerance from both of them
+        (a, b) = ((19.123456789, 50.987654321), (19.3333333333, 50.1111111111))
+        left = converters.feature.Feature(
+            shapely.geometry.LineString([a, b, (19.0, 50.0), a])
+        )
+        right = converters.feature.Feature(
+            shapely.geometry.LineString([b, a, (19.5, 51.0), b])
+        )
+        rv = borders.geoutils.split_by_topology([left, right], tolerance=1e-16)
+        common = [x for x in rv[0].geometry.geoms if x in list(rv[1].geometry.geoms)]
+        self.assertEqual(1, len(common))
+        self.assertAlmostEqual(
+            shapely.geometry.LineString([a, b]).length, common[0].length
+        )
+
+    def test_topology_lines_shared_by_3(self):
+        # three boxes:
+        # (0,2)---(1,2)---(2,2)
+        #   |       |       |
+        # (0,1)---(1,1)     |
+        #   |       |       |
+        # (0,0)---(1,0)----(2,0)
+        bottom = converters.feature.Feature(
+            shapely.geometry.LinearRing([(0, 0), (0, 1), (1, 1), (1, 0)])
+        )
+        upper = converters.feature.Feature(
+            shapely.geometry.LinearRing(reversed([(0, 1), (1, 1), (1, 2), (0, 2)]))
+        )
+        right = converters.feature.Feature(
+            shapely.geometry.LinearRing([(1, 0), (2, 0), (2, 2), (1, 2)])
+        )
+        original = [x.geometry for x in (bottom, upper, right)]
+
+        rv = borders.geoutils.split_by_topology([bottom, upper, right])
+
+        self.assertEqual([len(x.geometry.geoms) for x in rv], [3, 3, 3])
+        for before, after in zip(original, rv):
+            self.assertAlmostEqual(before.length, after.geometry.length)
+        self.assertEqual(
+            [shapely.geometry.LineString([(1, 1), (1, 0)])],
+            [x for x in rv[0].geometry.geoms if x in list(rv[2].geometry.geoms)],
+        )
+
+    def test_connected_components(self):
+        left = shapely.geometry.LineString([(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)])
+        far = shapely.geometry.LineString([(5, 5), (5, 6), (6, 6), (6, 5), (5, 5)])
+        right = shapely.geometry.LineString([(1, 1), (1, 0), (2, 0), (2, 1), (1, 1)])
+        # envelope overlaps with right, but doesn't touch it
+        corner = shapely.geometry.LineString([(1.9, 1.5), (3, 1.5), (3, 0.5)])
+        self.assertEqual(
+            [[0, 2], [1], [3]],
+            borders.geoutils.connected_components([left, far, right, corner]),
+        )
+
+    def test_split_by_components(self):
+        def boxes(xoff):
+            return [
+                converters.feature.Feature(
+                    shapely.geometry.LineString(
+                        [(x, 0), (x, 1), (x + 1, 1), (x + 1, 0), (x, 0)]
+                    )
+                )
+                for x in range(xoff, xoff + 3)
+            ]
+
+        serial = borders.geoutils.split_by_common_ways(boxes(0) + boxes(10))
+        parallel = borders.geoutils.split_by_components(
+            boxes(0) + boxes(10), max_workers=2, min_borders=0
+        )
+        self.assertEqual(
+            [x.geometry.wkb for x in serial], [x.geometry.wkb for x in parallel]
+        )
+
+    def test_split_by_components_shared_pool(self):
+        def boxes(xoff):
+            return [
+                converters.feature.Feature(
+                    shapely.geometry.LineString(
+                        [(x, 0), (x, 1), (x + 1, 1), (x + 1, 0), (x, 0)]
+                    )
+                )
+                for x in range(xoff, xoff + 3)
+            ]
+
+        serial = borders.geoutils.split_by_common_ways(boxes(0) + boxes(10))
+        with unittest.mock.patch("borders.geoutils.SPLIT_WORKERS", 2):
+            executor = borders.geoutils.get_split_executor()
+            for _ in range(2):
+                parallel = borders.geoutils.split_by_components(
+                    boxes(0) + boxes(10), min_borders=0
+                )
+                self.assertEqual(
+                    [x.geometry.wkb for x in serial],
+                    [x.geometry.wkb for x in parallel],
+                )
+            # the same pool serves all calls
+            self.assertIs(executor, borders.geoutils.get_split_executor())
+
+    def test_divide_bbox_global_grid(self):
+        left = borders.borders.divide_bbox((19.01, 52.01, 19.04, 52.03))
+        right = borders.borders.divide_bbox((19.03, 52.02, 19.07, 52.03))
+        self.assertEqual(
+            [(18.99, 52.0, 19.02, 52.04), (19.02, 52.0, 19.05, 52.04)], left
+        )
+        self.assertEqual(
+            [(19.02, 52.0, 19.05, 52.04), (19.05, 52.0, 19.08, 52.04)], right
+        )
+
+    def test_tiles_for_area(self):
+        # L-shaped area, top right tiles are far from it
+        area = shapely.geometry.Polygon(
+            [
+                (19.0, 52.0),
+                (19.06, 52.0),
+                (19.06, 52.01),
+                (19.01, 52.01),
+                (19.01, 52.08),
+                (19.0, 52.08),
+            ]
+        )
+        self.assertEqual(6, len(borders.borders.divide_bbox(area.bounds)))
+        self.assertEqual(
+            [
+                (18.99, 52.0, 19.02, 52.04),
+                (18.99, 52.04, 19.02, 52.08),
+                (19.02, 52.0, 19.05, 52.04),
+                (19.05, 52.0, 19.08, 52.04),
+            ],
+            borders.borders.tiles_for_area(area),
+        )
+
+    def test_working_area(self):
+        area = shapely.geometry.Polygon([(0, 0), (1, 0), (1, 1), (0.5, 0.1), (0, 1)])
+        working_area = borders.borders.WorkingArea(area)
+        buffered = area.buffer(borders.borders.WORKING_AREA_BUFFER)
+        geometries = [
+            shapely.geometry.box(0.1, 0.01, 0.2, 0.05),  # inside
+            shapely.geometry.box(0.4, 0.5, 0.6, 0.6),  # in envelope, but outside
+            shapely.geometry.box(0.9, 0.5, 1.1, 0.6),  # crosses the border
+            shapely.geometry.box(2, 2, 3, 3),  # far away
+            shapely.geometry.Polygon(),
+        ]
+        for geometry in geometries:
+            self.assertEqual(
+                geometry.intersects(buffered), working_area.intersects(geometry)
+            )
+            self.assertEqual(geometry.within(buffered), working_area.contains(geometry))
+
+    def test_emuia_tile_serializer(self):
+        serializer = borders.borders.EmuiaTileSerializer()
+        kml = ("<kml>zażółć</kml>" * 100000).encode("utf-8")
+        entry = {"time": 1500000000.5, "kml_lz4": lz4.frame.compress(kml)}
+        data = serializer.serialize(entry)
+        self.assertEqual(entry, serializer.deserialize(data))
+        self.assertEqual(
+            kml,
+            b"".join(
+                borders.borders._lz4_chunks(serializer.deserialize(data)["kml_lz4"])
+            ),
+        )
+
+    def test_emuia_cache_expiry(self):
+        cache = converters.tools.MemoryCache()
+        cache.add("fresh", {"time": time.time()})
+        cache.add("stale", {"time": time.time() - borders.borders.EMUIA_TILE_TTL})
+        self.assertIsNotNone(borders.borders._get_cached(lambda: cache, "fresh"))
+        self.assertIsNone(borders.borders._get_cached(lambda: cache, "stale"))
+        self.assertEqual(["fresh"], list(cache.keys()))
+
+    def test_download_from_emuia_retry(self):
+        with open("example.kml", "rb") as f:
+            kml = f.read()
+        session = FakeEmuiaSession(
+            [
+                requests.exceptions.ConnectionError("Connection reset"),
+                # error page of a 5xx response
+                FakeEmuiaResponse(b"<html>503 Service Unavailable</html>"),
+                FakeEmuiaResponse(kml),
+            ]
+        )
+        with unittest.mock.patch("time.sleep") as sleep:
+            (features, kml_lz4) = borders.borders.download_from_emuia(
+                (19.0, 52.0, 19.03, 52.04), session
+            )
+        self.assertEqual(["19.0,52.0,19.03,52.04"] * 3, session.requests)
+        backoff = borders.borders.EMUIA_RETRY_BACKOFF
+        self.assertEqual(
+            [unittest.mock.call(backoff), unittest.mock.call(backoff * 2)],
+            sleep.call_args_list,
+        )
+        self.assertEqual(
+            [x.tags for x in kml_to_shapely(kml.decode("utf-8"))],
+            [x.tags for x in features],
+        )
+        self.assertEqual(kml, lz4.frame.decompress(kml_lz4))
+
+    def test_download_from_emuia_give_up(self):
+        session = FakeEmuiaSession(
+            [FakeEmuiaResponse(b"Internal Server Error")]
+            * borders.borders.EMUIA_RETRIES
+        )
+        with unittest.mock.patch("time.sleep") as sleep:
+            with self.assertRaises(ValueError):
+                borders.borders.download_from_emuia((19.0, 52.0, 19.03, 52.04), session)
+        self.assertEqual(borders.borders.EMUIA_RETRIES, len(session.requests))
+        self.assertEqual(borders.borders.EMUIA_RETRIES - 1, sleep.call_count)
+
+    def test_fetch_tiles_from_emuia(self):
+        bboxes = [(19.0, 52.0 + i, 19.03, 52.04 + i) for i in range(10)]
+        lock = threading.Lock()
+        running = []
+        max_running = []
+        finished = []
+
+        def fetch(bbox):
+            with lock:
+                running.append(bbox)
+                max_running.append(len(running))
+            # later tiles finish first
+            time.sleep(0.01 * (len(bboxes) - bboxes.index(bbox)))
+            with lock:
+                running.remove(bbox)
+                finished.append(bbox)
+            return [
+                converters.feature.Feature(
+                    shapely.geometry.box(*bbox),
+                    {"IDENTYFIKATOR_MIEJSCOWOSCI": str(bbox)},
+                )
+            ]
+
+        with unittest.mock.patch("borders.borders.fetch_from_emuia", fetch):
+            features = borders.borders.fetch_tiles_from_emuia(bboxes)
+        self.assertEqual(borders.borders.EMUIA_CONCURRENCY, max(max_running))
+        self.assertNotEqual(bboxes, finished)
+        self.assertEqual(bboxes, [x.geometry.bounds for x in features])
+
+    def test_emuia_features_serializer(self):
+        serializer = borders.borders.EmuiaFeaturesSerializer()
+        with open("example.kml") as f:
+            features = kml_to_shapely(f.read())
+        data = serializer.serialize({"time": 1500000000.5, "features": features})
+        entry = serializer.deserialize(data)
+        self.assertEqual(1500000000.5, entry["time"])
+        self.assertEqual(len(features), len(entry["features"]))
+        for (feature, other) in zip(features, entry["features"]):
+            self.assertEqual(feature.tags, other.tags)
+            self.assertEqual(feature.geometry.wkb, other.geometry.wkb)
+        data = serializer.serialize({"time": 0.0, "features": []})
+        self.assertEqual([], serializer.deserialize(data)["features"])
+
+    def test_immutable_feature(self):
+        polygon = shapely.geometry.Polygon([(0, 0), (1, 0), (1, 1), (0, 0)])
+        feature = converters.feature.Feature(polygon, {"a": "1", "b": "2"})
+        same = converters.feature.Feature(
+            shapely.geometry.Polygon(polygon.exterior.coords), {"b": "2", "a": "1"}
+        )
+        other_tags = converters.feature.Feature(polygon, {"a": "1"})
+        other_geometry = converters.feature.Feature(
+            shapely.geometry.Polygon([(0, 0), (1, 1), (1, 0), (0, 0)]),
+            {"a": "1", "b": "2"},
+        )
+        self.assertEqual(
+            2,
+            len(
+                {
+                    converters.feature.ImmutableFeature(x)
+                    for x in (feature, same, other_tags)
+                }
+            ),
+        )
+        self.assertNotEqual(
+            converters.feature.ImmutableFeature(feature),
+            converters.feature.ImmutableFeature(other_geometry),
+        )
+
+    def test_dedup_by_id(self):
+        with open("example.kml") as f:
+            content = f.read()
+        features = kml_to_shapely(content)
+        no_id = converters.feature.Feature(shapely.geometry.Point(0, 0))
+        newer = converters.feature.Feature(
+            features[0].geometry, dict(features[0].tags, WERSJA_OD="2020-01-01")
+        )
+        rv = borders.borders.dedup_by_id(
+            features + [no_id, newer, no_id] + kml_to_shapely(content)
+        )
+        self.assertEqual(features + [no_id, newer, no_id], rv)
+
+    def test_remove_children(self):
+        parent = converters.feature.Feature(shapely.geometry.box(0, 0, 4, 1))
+        children = [
+            converters.feature.Feature(shapely.geometry.box(0, 0, 1, 1)),
+            converters.feature.Feature(shapely.geometry.box(2, 0, 3, 1)),
+        ]
+        borders.borders._remove_children(parent, children)
+        self.assertAlmostEqual(2, parent.geometry.area)
+
+        # second child would remove what is left of the parent
+        parent = converters.feature.Feature(shapely.geometry.box(0, 0, 2, 1))
+        children = [
+            converters.feature.Feature(shapely.geometry.box(0, 0, 1, 1)),
+            converters.feature.Feature(shapely.geometry.box(1, 0, 2, 1)),
+        ]
+        borders.borders._remove_children(parent, children)
+        self.assertTrue(
+            parent.geometry.equals(shapely.geometry.box(1, 0, 2, 1)), parent.geometry
+        )
+
+    @staticmethod
+    def _wikidata_entry(name: str, x: float, y: float, q: int):
+        return borders.wikidata.WikidataSimcEntry(
+            {
+                "coords": {"value": "Point({0} {1})".format(x, y)},
+                "miejscowosc": {
+                    "value": "http://www.wikidata.org/entity/Q{0}".format(q)
+                },
+                "terc": {"value": "0000000"},
+                "article": {"value": "https://pl.wikipedia.org/wiki/" + name},
+                "miejscowoscLabel": {"value": name},
+            }
+        )
+
+    def test_add_wikidata(self):
+        features = [
+            converters.feature.Feature(
+                shapely.geometry.box(i, 0, i + 1, 1), {"NAZWA": "Wieś {0}".format(i)}
+            )
+            for i in range(300)
+        ]
+        # two borders with the same name, told apart by geometry
+        features.extend(
+            converters.feature.Feature(
+                shapely.geometry.box(i, 1, i + 1, 2), {"NAZWA": "Kolonia"}
+            )
+            for i in range(2)
+        )
+        wikidata = [
+            self._wikidata_entry("Wieś {0}".format(i), i + 0.5, 0.5, i)
+            for i in range(300)
+        ]
+        wikidata.append(self._wikidata_entry("Kolonia (gmina)", 1.5, 1.5, 1001))
+        wikidata.append(self._wikidata_entry("Kolonia (wieś)", 0.5, 1.5, 1000))
+
+        borders.borders.add_wikidata(wikidata, features)
+
+        self.assertEqual(
+            ["Q{0}".format(i) for i in range(300)] + ["Q1000", "Q1001"],
+            [x.tags.get("wikidata") for x in features],
+        )
+        self.assertEqual("pl:Kolonia (wieś)", features[300].tags["wikipedia"])
+
+    def test_fetch_from_wikidata_cached(self):
+        with open("example.wikidata") as f:
+            bindings = json.load(f)["results"]["bindings"]
+        terc = bindings[0]["terc"]["value"]
+        # two gminas of one powiat in one response
+        neighbour = terc[:4] + "999"
+        by_terc = {terc: bindings, neighbour: bindings[:1]}
+        cache = converters.tools.MemoryCache()
+        with unittest.mock.patch(
+            "borders.wikidata.get_wikidata_cache", return_value=cache
+        ), unittest.mock.patch(
+            "borders.wikidata.fetch_bindings", return_value=by_terc
+        ) as fetch_bindings:
+            rv = borders.wikidata.fetch_from_wikidata(terc, batch=4)
+            fetch_bindings.assert_called_once_with(terc[:4])
+            self.assertEqual(len(bindings), len(rv))
+            self.assertEqual(
+                [str(x) for x in rv],
+                [str(x) for x in borders.wikidata.fetch_from_wikidata(terc, batch=4)],
+            )
+            self.assertEqual(
+                1, len(borders.wikidata.fetch_from_wikidata(neighbour, batch=4))
+            )
+            self.assertEqual(1, fetch_bindings.call_count)
+
+    def test_feature_to_osm_chunks(self):
+        def converter():
+            return borders.borders.FeatureToOsm(
+                [
+                    converters.feature.Feature(
+                        geometry=shapely.geometry.box(x, 0, x + 1, 1),
+                        tags={"name": '<{0}> & "{0}"'.format(x)},
+                    )
+                    for x in range(10)
+                ],
+                tag_mapping=lambda x, y: y.items() if x == "relation" else (),
+                borders_mapping=lambda x: x,
+            )
+
+        expected = converter().tostring()
+        chunks = list(converter().iter_chunks(chunk_size=100))
+        self.assertEqual(11, len(chunks))
+        self.assertTrue(
+            chunks[0].startswith(borders.borders.XML_DECLARATION.encode("utf-8"))
+        )
+        self.assertIn(b"<relation", chunks[0])
+        self.assertEqual(expected, b"".join(chunks))
+        rv = overpy.Result.from_xml(expected.decode("utf-8"))
+        self.assertEqual(10, len(rv.relations))
+        self.assertEqual('<0> & "0"', rv.relations[0].tags["name"])
+
+    def test_coordinate_key(self):
+        for point in ((19.1234567, 50.0), (-179.9999999, -89.5), (0.0000004, -0.1)):
+            (lon, lat) = borders.borders.coordinate_from_key(
+                borders.borders.coordinate_key(point)
+            )
+            self.assertEqual(point[0], float(borders.borders.format_coordinate(lon)))
+            self.assertEqual(point[1], float(borders.borders.format_coordinate(lat)))
+        self.assertEqual("-0.1", borders.borders.format_coordinate(-1000000))
+        self.assertEqual("50", borders.borders.format_coordinate(500000000))
+        self.assertEqual(
+            borders.borders.coordinate_key((19.12345671, 50.0)),
+            borders.borders.coordinate_key((19.12345669, 50.00000001)),
+        )
+        self.assertEqual(
+            2, len(borders.borders.way_key([(1, 1), (1, 1.00000001), (2, 2)]))
+        )
+
+    def test_feature_to_osm_degenerate_way(self):
+        # hole smaller than OSM precision collapses into a single node
+        polygon = shapely.geometry.box(19, 50, 19.5, 50.5).difference(
+            shapely.geometry.box(19.2, 50.2, 19.20000001, 50.20000001)
+        )
+        self.assertEqual(1, len(polygon.interiors))
+        rv = overpy.Result.from_xml(
+            borders.borders.FeatureToOsm(
+                [converters.feature.Feature(geometry=polygon, tags={"name": "a"})],
+                tag_mapping=lambda x, y: y.items() if x == "relation" else (),
+                borders_mapping=lambda x: x,
+            )
+            .tostring()
+            .decode("utf-8")
+        )
+        self.assertEqual(1, len(rv.ways))
+        self.assertEqual(["outer"], [x.role for x in rv.relations[0].members])
+
+    def test_canonical_way_key(self):
+        key = borders.borders.canonical_way_key
+        self.assertEqual(key((3, 1, 2)), key((2, 1, 3)))
+        self.assertNotEqual(key((3, 1, 2)), key((1, 3, 2)))
+        ring = (5, 3, 4, 1, 2, 5)
+        self.assertEqual(key(ring), key((1, 2, 5, 3, 4, 1)))
+        self.assertEqual(key(ring), key((4, 3, 5, 2, 1, 4)))
+        self.assertNotEqual(key(ring), key((5, 4, 3, 1, 2, 5)))
+
+        ring = shapely.geometry.Polygon([(0, 0), (1, 0), (1, 1), (0, 1)])
+        converter = borders.borders.FeatureToOsm(
+            [
+                converters.feature.Feature(geometry=ring, tags={"name": "a"}),
+                converters.feature.Feature(
+                    geometry=shapely.geometry.polygon.orient(ring, -1),
+                    tags={"name": "b"},
+                ),
+            ],
+            tag_mapping=lambda x, y: y.items() if x == "relation" else (),
+            borders_mapping=lambda x: x,
+        )
+        rv = overpy.Result.from_xml(converter.tostring().decode("utf-8"))
+        self.assertEqual(1, len(rv.ways))
+        self.assertEqual(4, len(rv.nodes))
+
     @unittest.skip("Test fails, although usually it works ok")
     def test_create_multi_string(self):
         other_geo = shapely.geometry.asShape(
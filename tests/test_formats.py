@@ -0,0 +1,146 @@
+import gzip
+import io
+import itertools
+import json
+import logging
+import struct
+import unittest
+import zlib
+
+import shapely.geometry
+
+import borders.borders
+import borders.formats
+import borders.geoutils
+import converters.feature
+from borders import fileformat_pb2, osmformat_pb2
+
+logging.basicConfig(level=logging.INFO)
+
+
+def converter():
+    ring = shapely.geometry.Polygon([(19, 50), (19.5, 50), (19.5, 50.5), (19, 50.5)])
+    return borders.borders.FeatureToOsm(
+        [
+            converters.feature.Feature(geometry=ring, tags={"name": "Łódź"}),
+            converters.feature.Feature(
+                geometry=shapely.geometry.box(19.5, 50, 20, 50.5), tags={"name": "b"}
+            ),
+        ],
+        tag_mapping=lambda x, y: y.items() if x == "relation" else (),
+        borders_mapping=lambda x: x,
+    )
+
+
+def read_pbf(data: bytes):
+    offset = 0
+    while offset < len(data):
+        (length,) = struct.unpack_from("!I", data, offset)
+        offset += 4
+        header = fileformat_pb2.BlobHeader.FromString(data[offset : offset + length])
+        offset += length
+        blob = fileformat_pb2.Blob.FromString(data[offset : offset + header.datasize])
+        offset += header.datasize
+        yield (header.type, zlib.decompress(blob.zlib_data))
+
+
+class FormatsTests(unittest.TestCase):
+    def test_format_from_filename(self):
+        self.assertEqual("osm", borders.formats.format_from_filename("a.osm"))
+        self.assertEqual("osm.gz", borders.formats.format_from_filename("a.osm.gz"))
+        self.assertEqual("pbf", borders.formats.format_from_filename("a.osm.pbf"))
+        self.assertEqual("geojson", borders.formats.format_from_filename("a.geojson"))
+        self.assertIsNone(borders.formats.format_from_filename("a.txt"))
+
+    def test_gzip(self):
+        output = io.BytesIO()
+        size = borders.formats.write(converter(), output, "osm.gz")
+        self.assertEqual(size, len(output.getvalue()))
+        self.assertEqual(converter().tostring(), gzip.decompress(output.getvalue()))
+
+    def test_geojson(self):
+        output = io.BytesIO()
+        borders.formats.write(converter(), output, "geojson")
+        rv = json.loads(output.getvalue().decode("utf-8"))
+        self.assertEqual("FeatureCollection", rv["type"])
+        self.assertEqual(2, len(rv["features"]))
+        self.assertEqual({"name": "Łódź"}, rv["features"][0]["properties"])
+        self.assertTrue(
+            shapely.geometry.box(19, 50, 19.5, 50.5).equals(
+                shapely.geometry.shape(rv["features"][0]["geometry"])
+            )
+        )
+
+    def test_geojson_polygons(self):
+        polygon = shapely.geometry.box(19, 50, 20, 51).difference(
+            shapely.geometry.box(19.2, 50.2, 19.4, 50.4)
+        )
+        island = shapely.geometry.box(19.25, 50.25, 19.3, 50.3)
+        geometries = [polygon, shapely.geometry.MultiPolygon([polygon, island])]
+        converter = borders.borders.FeatureToOsm(
+            [converters.feature.Feature(geometry=x.boundary) for x in geometries],
+            tag_mapping=lambda x, y: (),
+            borders_mapping=borders.geoutils.split_by_common_ways,
+        )
+        output = io.BytesIO()
+        borders.formats.write(converter, output, "geojson")
+        rv = json.loads(output.getvalue().decode("utf-8"))
+        for (geometry, feature) in zip(geometries, rv["features"]):
+            shape = shapely.geometry.shape(feature["geometry"])
+            self.assertEqual(geometry.geom_type, shape.geom_type)
+            self.assertTrue(geometry.equals(shape))
+        # exterior ring is counterclockwise
+        self.assertTrue(shapely.geometry.LinearRing(shape.geoms[0].exterior).is_ccw)
+
+    def test_pbf(self):
+        output = io.BytesIO()
+        borders.formats.write(converter(), output, "pbf")
+        blocks = list(read_pbf(output.getvalue()))
+        self.assertEqual(["OSMHeader", "OSMData"], [x[0] for x in blocks])
+        block = osmformat_pb2.PrimitiveBlock.FromString(blocks[1][1])
+        strings = [x.decode("utf-8") for x in block.stringtable.s]
+        (nodes, ways, relations) = block.primitivegroup
+
+        node_ids = list(itertools.accumulate(nodes.dense.id))
+        coords = dict(
+            zip(
+                node_ids,
+                zip(
+                    itertools.accumulate(nodes.dense.lon),
+                    itertools.accumulate(nodes.dense.lat),
+                ),
+            )
+        )
+        self.assertEqual(6, len(coords))
+        self.assertIn((195000000, 505000000), coords.values())
+
+        self.assertEqual(2, len(ways.ways))
+        for way in ways.ways:
+            self.assertTrue(all(x in coords for x in itertools.accumulate(way.refs)))
+
+        self.assertEqual(2, len(relations.relations))
+        relation = relations.relations[0]
+        self.assertEqual(["name"], [strings[x] for x in relation.keys])
+        self.assertEqual(["Łódź"], [strings[x] for x in relation.vals])
+        self.assertEqual(["outer"], [strings[x] for x in relation.roles_sid])
+        self.assertEqual([ways.ways[0].id], list(itertools.accumulate(relation.memids)))
+
+    def test_pbf_block_size(self):
+        output = io.BytesIO()
+        for chunk in borders.formats.FeatureToPbf.from_converter(
+            converter()
+        ).iter_chunks(chunk_size=3):
+            output.write(chunk)
+        blocks = list(read_pbf(output.getvalue()))
+        # 10 entities in blocks of at most 3, even within a single border
+        self.assertEqual(["OSMHeader"] + ["OSMData"] * 4, [x[0] for x in blocks])
+        sizes = []
+        for (_, data) in blocks[1:]:
+            block = osmformat_pb2.PrimitiveBlock.FromString(data)
+            sizes.append(
+                sum(
+                    len(x.dense.id) + len(x.ways) + len(x.relations)
+                    for x in block.primitivegroup
+                )
+            )
+        self.assertEqual([3, 3, 3, 1], sizes)
@@ -1,5 +1,7 @@
+import glob
 import logging
 import unittest
+import xml.etree.ElementTree
 
 import shapely.geometry
 
@@ -43,3 +45,94 @@ class KmlShapelyTests(unittest.TestCase):
                     type(feature.geometry), feature
                 ),
             )
+
+    def test_multi_geometry_rings(self):
+        # WKB of features, and so their fingerprints and the order of written nodes,
+        # depends on where rings start
+        with open("example.kml") as f:
+            features = converters.kmlshapely.kml_to_shapely(f.read())
+        starts = dict(
+            (x.get_tag("name"), [y.exterior.coords[0] for y in x.geometry.geoms])
+            for x in features
+            if isinstance(x.geometry, shapely.geometry.MultiPolygon)
+        )
+        self.assertEqual(
+            [
+                (22.59475643, 49.91342309),
+                (16.90374048, 52.34522433),
+                (20.32031495, 52.87796699),
+                (19.61077028, 53.79743648),
+            ],
+            starts["layer_miejscowosci_granica.1461634"],
+        )
+        self.assertEqual(
+            [
+                (22.66173905, 49.98223367),
+                (16.82650643, 51.20846621),
+                (16.92782674, 52.36851669),
+                (19.74507587, 52.44250119),
+                (19.60757458, 53.74272182),
+            ],
+            starts["layer_miejscowosci_granica.1481347"],
+        )
+
+    def test_iter_kml_to_shapely(self):
+        with open("example.kml", "rb") as f:
+            content = f.read()
+        expected = converters.kmlshapely.kml_to_shapely(content.decode("utf-8"))
+        chunks = [content[i : i + 1000] for i in range(0, len(content), 1000)]
+        features = list(converters.kmlshapely.iter_kml_to_shapely(chunks))
+        self.assertEqual(len(expected), len(features))
+        for (feature, other) in zip(features, expected):
+            self.assertEqual(other.tags, feature.tags)
+            self.assertTrue(other.geometry.equals(feature.geometry))
+
+    def test_iter_kml_to_shapely_invalid(self):
+        with self.assertRaises(xml.etree.ElementTree.ParseError):
+            list(converters.kmlshapely.iter_kml_to_shapely([b"Internal error"]))
+        with open("example.kml", "rb") as f:
+            truncated = f.read()[:-100]
+        with self.assertRaises(xml.etree.ElementTree.ParseError):
+            list(converters.kmlshapely.iter_kml_to_shapely([truncated]))
+        with self.assertRaises(ValueError):
+            list(
+                converters.kmlshapely.iter_kml_to_shapely(
+                    [b"<ServiceExceptionReport></ServiceExceptionReport>"]
+                )
+            )
+
+    def test_description_parsers(self):
+        descriptions = []
+        for name in glob.glob("*.kml"):
+            with open(name) as f:
+                tree = xml.etree.ElementTree.fromstring(f.read())
+            descriptions.extend(
+                x.text for x in tree.iter(converters.kmlshapely.ns + "description")
+            )
+        # markup that fast parser does not handle by itself
+        descriptions.append(
+            '<span class="atr-name">A&amp;B</span>: '
+            '<span class="atr-value"><a href="#">link</a></span>'
+        )
+        for description in descriptions:
+            expected = converters.kmlshapely.description_tags_bs4(description)
+            for parser in converters.kmlshapely.DESCRIPTION_PARSERS.values():
+                self.assertEqual(expected, parser(description))
+
+    def test_ring_to_shape(self):
+        ring = xml.etree.ElementTree.fromstring(
+            '<LinearRing xmlns="http://www.opengis.net/kml/2.2"><coordinates>'
+            "21.0,52.0,0 21.1,52.0,0\n21.1,52.1,0 21.0,52.0,0"
+            "</coordinates></LinearRing>"
+        )
+        self.assertEqual(
+            shapely.geometry.Polygon([(21.0, 52.0), (21.1, 52.0), (21.1, 52.1)]),
+            converters.kmlshapely.ring_to_shape(ring),
+        )
+        ring.find(converters.kmlshapely.ns + "coordinates").text = "21.0,52.0 21.1,52.0"
+        with self.assertRaises(Exception):
+            converters.kmlshapely.ring_to_shape(ring)
+        for text in ("21.0,52.0 21.1,52.0,0 21.0,52.0", "21.0,52.0 21.1,5x 21.0,52.0"):
+            ring.find(converters.kmlshapely.ns + "coordinates").text = text
+            with self.assertRaises(ValueError):
+                converters.kmlshapely.ring_to_shape(ring)
@@ -0,0 +1,42 @@
+import unittest
+import unittest.mock
+
+import shapely.geometry
+
+import borders.borders
+import borders.formats
+import converters.feature
+import rest_server
+
+
+class RestServerTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # as registered by start_rest_server outside of debug mode
+        rest_server.app.errorhandler(Exception)(rest_server.report_exception)
+
+    def test_conversion_error(self):
+        def failing_mapping(borders):
+            raise ValueError("Splitting failed")
+
+        def converter(*args, **kwargs):
+            return borders.borders.FeatureToOsm(
+                [converters.feature.Feature(shapely.geometry.box(0, 0, 1, 1).boundary)],
+                borders_mapping=failing_mapping,
+                filter_func=lambda x: failing_mapping([x]),
+            )
+
+        client = rest_server.app.test_client()
+        with unittest.mock.patch(
+            "borders.borders.get_borders_converter", side_effect=converter
+        ):
+            for output_format in borders.formats.OUTPUT_FORMATS.values():
+                resp = client.get(
+                    "/osm-borders/all/1234.{0}".format(output_format.extension)
+                )
+                # error document instead of a truncated file
+                self.assertEqual(
+                    "attachment; filename=error.osm",
+                    resp.headers["Content-Disposition"],
+                )
+                self.assertIn(b"Splitting failed", resp.data)
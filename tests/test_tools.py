@@ -0,0 +1,410 @@
+import logging
+import os
+import shelve
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+
+import converters.tools
+
+logging.basicConfig(level=logging.INFO)
+
+
+class FakeDynamoClient:
+    def __init__(self, items: dict, unprocessed: int):
+        self.items = items
+        self.unprocessed = unprocessed
+        self.requests = []
+
+    def batch_get_item(self, RequestItems):
+        self.requests.append(RequestItems)
+        ((table, request),) = RequestItems.items()
+        keys = request["Keys"]
+        # leave some keys for another call, like DynamoDB does when throttled
+        rest = keys[: self.unprocessed]
+        self.unprocessed = 0
+        rv = {
+            "Responses": {
+                table: [
+                    {"key": x["key"], "value": {"B": self.items[x["key"]["S"]]}}
+                    for x in keys[len(rest) :]
+                    if x["key"]["S"] in self.items
+                ]
+            }
+        }
+        if rest:
+            rv["UnprocessedKeys"] = {table: {"Keys": rest}}
+        return rv
+
+
+class FakeDynamoTable:
+    def __init__(self, client: FakeDynamoClient):
+        self.name = "test"
+        self.meta = type("Meta", (), {"client": client})
+
+
+class ToolsTests(unittest.TestCase):
+    def test_get_many(self):
+        cache = converters.tools.MemoryCache()
+        cache.add("a", {"value": 1})
+        cache.add("b", {"value": 2})
+        self.assertEqual(
+            {"a": {"value": 1}, "b": {"value": 2}}, cache.get_many(["a", "b", "c"])
+        )
+        self.assertEqual({}, cache.get_many([]))
+
+    def test_iter_prefix(self):
+        cache = converters.tools.MemoryCache()
+        cache.reload(dict((x, {"value": x}) for x in ("02", "0201", "0201011", "12")))
+        self.assertEqual(["0201", "0201011"], list(cache.iter_prefix("020")))
+        self.assertEqual(["02", "0201", "0201011", "12"], list(cache.iter_prefix("")))
+        self.assertEqual([], list(cache.iter_prefix("3")))
+
+        # index is kept current after it was built
+        cache.add("0202", {"value": "0202"})
+        cache.add("0202", {"value": "0202"})
+        cache.delete("0201011")
+        self.assertEqual(["0201", "0202"], list(cache.iter_prefix("020")))
+        cache.reload({"1201": {"value": "1201"}})
+        self.assertEqual(["12", "1201"], list(cache.iter_prefix("12")))
+
+        # index is built from keys on first use
+        cache = converters.tools.MemoryCache()
+        cache.cache.update(("{0:02d}".format(x), x) for x in range(20, 0, -1))
+        self.assertEqual(
+            ["10", "11", "12", "13", "14", "15", "16", "17", "18", "19"],
+            list(cache.iter_prefix("1")),
+        )
+
+    def test_iter_prefix_version(self):
+        driver = converters.tools.MemoryCacheDriver()
+        manager = converters.tools.CacheManager(driver)
+        with unittest.mock.patch.object(
+            converters.tools.MemoryCache, "keys", autospec=True
+        ) as keys:
+            keys.side_effect = lambda self: self.cache.keys()
+            manager.create_cache("test").reload({"02": {}, "0201": {}})
+            # index is not built by the load
+            keys.assert_not_called()
+            manager.mark_ready("test", 1)
+            cache = manager.get_cache("test")
+            self.assertEqual(["02", "0201"], list(cache.iter_prefix("02")))
+            self.assertEqual(["02", "0201"], list(cache.iter_prefix("02")))
+            self.assertEqual(1, keys.call_count)
+
+            # new version written by other process, that doesn't update the index
+            driver.caches["test"].cache["0202"] = {}
+            manager.meta.add("test", dict(manager.meta.get("test"), version=2))
+            self.assertEqual(["02", "0201", "0202"], list(cache.iter_prefix("02")))
+            self.assertEqual(2, keys.call_count)
+
+    def test_shelve_get_many(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with shelve.open(os.path.join(directory, "test"), flag="n") as shlv:
+                cache = converters.tools.ShelveCache(
+                    shlv, converters.tools.JsonSerializer()
+                )
+                cache.add("a", {"value": 1})
+                cache.add("b", {"value": 2})
+                shlv["empty"] = b""
+                self.assertEqual(
+                    {"a": {"value": 1}, "b": {"value": 2}},
+                    cache.get_many(["a", "b", "c", "empty"]),
+                )
+                self.assertEqual(
+                    dict((x, cache.get(x)) for x in ("a", "b")),
+                    cache.get_many(iter(["a", "b"])),
+                )
+
+    def test_shelve_file_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            driver = converters.tools.ShelveCacheDriver()
+            driver.directory = directory
+            cache = driver.get_or_create("test")
+            other = driver.get_or_create("test")
+            self.assertIsNone(cache.get("a"))
+            cache.add("a", {"value": 1})
+            other.add("b", {"value": 2})
+            # file is closed between operations, so other handle sees the changes
+            self.assertEqual(
+                {"a": {"value": 1}, "b": {"value": 2}}, cache.get_many(["a", "b"])
+            )
+            other.delete("a")
+            self.assertIsNone(cache.get("a"))
+            self.assertEqual(["b"], list(cache.keys()))
+
+    def test_shelve_meta(self):
+        with tempfile.TemporaryDirectory() as directory:
+            driver = converters.tools.ShelveCacheDriver()
+            driver.directory = directory
+            # two processes, e.g. gunicorn workers
+            manager = converters.tools.CacheManager(driver)
+            other = converters.tools.CacheManager(driver)
+            self.assertIsInstance(manager.meta, converters.tools.ShelveFileCache)
+            self.assertEqual(-1, other.version("test"))
+
+            manager.create_cache("test").add("a", {"value": 1})
+            with self.assertRaises(converters.tools.CacheNotInitialized):
+                other.get_cache("test")
+            manager.mark_ready("test", 3)
+            self.assertEqual(3, other.version("test"))
+            self.assertEqual({"value": 1}, other.get_cache("test", version=3).get("a"))
+
+            manager.mark_ready("test", 4)
+            self.assertEqual(4, other.version("test"))
+
+    def test_sqlite_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            driver = converters.tools.SqliteCacheDriver()
+            driver.directory = directory
+            with self.assertRaises(converters.tools.CacheNotInitialized):
+                driver.get_table("test")
+            cache = driver.create("test")
+            cache.reload(dict((x, {"value": x}) for x in ("02", "0201", "0201011")))
+            cache.add("12", {"value": "12"})
+            cache.delete("0201011")
+
+            # other connection, as in other process
+            other = driver.get_table("test")
+            self.assertEqual({"value": "02"}, other.get("02"))
+            self.assertIsNone(other.get("0201011"))
+            self.assertEqual(
+                {"02": {"value": "02"}, "12": {"value": "12"}},
+                other.get_many(["02", "12", "13"]),
+            )
+            self.assertEqual(["02", "0201"], list(other.iter_prefix("02")))
+            self.assertEqual(["02", "0201", "12"], list(other.keys()))
+
+            read_only = converters.tools.SqliteCache(
+                driver._path("test"), converters.tools.JsonSerializer(), read_only=True
+            )
+            self.assertEqual({"value": "12"}, read_only.get("12"))
+            with self.assertRaises(sqlite3.OperationalError):
+                read_only.add("13", {"value": "13"})
+
+            self.assertEqual([], list(driver.create("test").keys()))
+            self.assertEqual([], list(other.keys()))
+
+            manager = converters.tools.CacheManager(driver)
+            manager.create_cache("versioned").reload({"a": {"value": 1}})
+            manager.mark_ready("versioned", 1)
+            self.assertEqual(
+                {"value": 1}, manager.get_cache("versioned", version=1).get("a")
+            )
+
+    def test_snapshot(self):
+        driver = converters.tools.MemoryCacheDriver()
+        manager = converters.tools.CacheManager(driver)
+        source = manager.create_cache("test")
+        source.reload(
+            dict((str(x), {"value": x}) for x in (1, 2, 12, 123, 13, 3, "ą", ""))
+        )
+        with tempfile.TemporaryDirectory() as directory, unittest.mock.patch(
+            "converters.tools.SNAPSHOT_DIRECTORY", directory
+        ), unittest.mock.patch(
+            "converters.tools.get_cache_manager", return_value=manager
+        ):
+            manager.mark_ready("test", 1)
+            converters.tools.create_snapshot("test")
+
+            snapshot_driver = converters.tools.SnapshotCacheDriver(driver)
+            cache = snapshot_driver.get_table("test")
+            self.assertIsInstance(cache, converters.tools.SnapshotCache)
+            self.assertEqual(1, cache.version)
+            self.assertEqual({"value": 12}, cache.get("12"))
+            self.assertEqual({"value": "ą"}, cache.get("ą"))
+            self.assertEqual({"value": ""}, cache.get(""))
+            self.assertIsNone(cache.get("4"))
+            self.assertIsNone(cache.get("0"))
+            self.assertEqual({"value": 0}, cache.get("11", {"value": 0}))
+            self.assertEqual(
+                {"1": {"value": 1}, "3": {"value": 3}}, cache.get_many(["1", "3", "4"])
+            )
+            self.assertEqual(["12", "123"], list(cache.iter_prefix("12")))
+            self.assertEqual(
+                ["", "1", "12", "123", "13", "2", "3", "ą"], list(cache.keys())
+            )
+            with self.assertRaises(converters.tools.CacheError):
+                cache.add("4", {"value": 4})
+
+            # version of the snapshot is checked, not the one in metadata
+            manager.mark_ready("test", 2)
+            snapshot_manager = converters.tools.CacheManager(snapshot_driver)
+            with self.assertRaises(converters.tools.CacheExpired):
+                snapshot_manager.get_cache("test", version=2)
+            self.assertIsInstance(
+                snapshot_manager.get_cache("test", version=1),
+                converters.tools.SnapshotCache,
+            )
+
+            # other caches come from fallback driver
+            self.assertIs(driver.get_table("meta"), snapshot_driver.get_table("meta"))
+            # snapshot is dropped, when cache is created again
+            snapshot_driver.create("test")
+            self.assertIsInstance(
+                snapshot_driver.get_table("test"), converters.tools.MemoryCache
+            )
+
+    def test_snapshot_stored_values(self):
+        with tempfile.TemporaryDirectory() as directory, unittest.mock.patch(
+            "converters.tools.SNAPSHOT_DIRECTORY", directory
+        ):
+            driver = converters.tools.SqliteCacheDriver()
+            driver.directory = directory
+            manager = converters.tools.CacheManager(driver)
+            source = manager.create_cache("test")
+            source.reload(dict((str(x), {"value": x}) for x in range(100)))
+            manager.mark_ready("test", 1)
+            stored = source.get_many_serialized(["12"])["12"]
+
+            serializer = converters.tools.JsonSerializer()
+            with unittest.mock.patch(
+                "converters.tools.get_cache_manager", return_value=manager
+            ), unittest.mock.patch.object(
+                serializer, "serialize", side_effect=AssertionError
+            ), unittest.mock.patch.object(
+                serializer, "deserialize", side_effect=AssertionError
+            ):
+                converters.tools.create_snapshot("test", serializer)
+
+            with open(converters.tools.snapshot_path("test"), "rb") as f:
+                self.assertIn(b"12" + stored, f.read())
+            cache = converters.tools.SnapshotCacheDriver(driver).get_table("test")
+            self.assertEqual({"value": 12}, cache.get("12"))
+            self.assertEqual(100, len(list(cache.keys())))
+
+    def test_lru_cache(self):
+        driver = converters.tools.MemoryCacheDriver()
+        manager = converters.tools.CacheManager(driver)
+        manager.create_cache("test").reload(
+            dict((str(x), {"value": x}) for x in range(10))
+        )
+        manager.mark_ready("test", 1)
+        with unittest.mock.patch("converters.tools.CACHE_LRU_SIZE", 5):
+            cache = manager.get_cache("test")
+        self.assertIsInstance(cache, converters.tools.LruCache)
+
+        self.assertEqual({"value": 1}, cache.get("1"))
+        self.assertIs(cache.get("1"), cache.get("1"))
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+        self.assertIsNone(cache.get("11"))
+        self.assertEqual(
+            {"1": {"value": 1}, "2": {"value": 2}}, cache.get_many(["1", "2", "12"])
+        )
+        self.assertEqual((3, 4), (cache.hits, cache.misses))
+
+        # modifications are visible at once
+        cache.add("1", {"value": "one"})
+        self.assertEqual({"value": "one"}, cache.get("1"))
+        driver.get_table("test").add("2", {"value": "two"})
+        self.assertEqual({"value": 2}, cache.get("2"))
+        manager.mark_ready("test", 2)
+        self.assertEqual({"value": "two"}, cache.get("2"))
+
+        # least recently used entries are dropped
+        cache.get_many(str(x) for x in range(10))
+        self.assertEqual(5, len(cache._lru))
+
+        # limited by size of entries
+        cache = converters.tools.LruCache(
+            driver.get_table("test"), 3, getsizeof=lambda x: len(str(x["value"]))
+        )
+        cache.get_many(["1", "3", "4"])
+        self.assertEqual(["3", "4"], sorted(cache._lru.keys()))
+
+    def test_lru_cache_for_update(self):
+        with tempfile.TemporaryDirectory() as directory:
+            driver = converters.tools.SqliteCacheDriver()
+            driver.directory = directory
+            manager = converters.tools.CacheManager(driver)
+            manager.create_cache("test").reload({"1": {"value": 1}})
+            manager.mark_ready("test", 1)
+            versioned = converters.tools.VersionedCache("test")
+            versioned._get_serializer = converters.tools.JsonSerializer
+            with unittest.mock.patch(
+                "converters.tools.CACHE_LRU_SIZE", 5
+            ), unittest.mock.patch(
+                "converters.tools.get_cache_manager", return_value=manager
+            ):
+                with self.assertRaises(converters.tools.CacheExpired):
+                    versioned._get_cache(2)
+                self.assertNotIn("test", manager.open_caches)
+                cache = versioned._get_cache(1)
+                self.assertIsInstance(cache, converters.tools.LruCache)
+                entry = cache.get("1")
+                # update handlers modify entries in place
+                update = versioned._get_cache_for_update(1)
+                self.assertNotIsInstance(update, converters.tools.LruCache)
+                update.get("1")["value"] = 2
+                self.assertEqual({"value": 1}, entry)
+                self.assertIs(entry, cache.get("1"))
+
+    def test_dynamo_get_many(self):
+        serializer = converters.tools.JsonSerializer()
+        items = dict(
+            (str(x), serializer.serialize({"value": x})) for x in range(0, 250, 2)
+        )
+        client = FakeDynamoClient(items, unprocessed=10)
+        cache = converters.tools.DynamoCache(FakeDynamoTable(client), serializer)
+        rv = cache.get_many(str(x) for x in range(250))
+        self.assertEqual(dict((str(x), {"value": x}) for x in range(0, 250, 2)), rv)
+        # 3 chunks of at most 100 keys and one retry of unprocessed keys
+        self.assertEqual(4, len(client.requests))
+        self.assertTrue(all(len(x["test"]["Keys"]) <= 100 for x in client.requests))
+
+    def test_dynamo_get_many_throttled(self):
+        client = FakeDynamoClient({}, unprocessed=1)
+        # every call leaves one key unprocessed
+        client.batch_get_item = unittest.mock.Mock(
+            side_effect=lambda RequestItems: {
+                "Responses": {},
+                "UnprocessedKeys": RequestItems,
+            }
+        )
+        cache = converters.tools.DynamoCache(
+            FakeDynamoTable(client), converters.tools.JsonSerializer()
+        )
+        with unittest.mock.patch("time.sleep"):
+            with self.assertRaises(converters.tools.CacheError):
+                cache.get_many(["a"])
+        self.assertEqual(
+            converters.tools.DYNAMO_BATCH_GET_ATTEMPTS,
+            client.batch_get_item.call_count,
+        )
+
+    def test_dynamo_get_or_create(self):
+        class ResourceNotFoundException(Exception):
+            pass
+
+        client = unittest.mock.Mock()
+        client.exceptions.ResourceNotFoundException = ResourceNotFoundException
+        client.exceptions.ResourceInUseException = type("InUse", (Exception,), {})
+        client.describe_table.side_effect = ResourceNotFoundException()
+        dynamodb = unittest.mock.Mock()
+        dynamodb.meta.client = client
+        driver = converters.tools.DynamoCacheDriver(dynamodb)
+
+        driver.get_or_create("tiles")
+        client.create_table.assert_called_once()
+        self.assertEqual(
+            [{"AttributeName": "key", "KeyType": "HASH"}],
+            client.create_table.call_args[1]["KeySchema"],
+        )
+        client.get_waiter.assert_called_once_with("table_exists")
+        dynamodb.Table.assert_called_with("tiles")
+
+        # existing table is used as it is
+        client.reset_mock()
+        client.describe_table.side_effect = None
+        driver.get_or_create("tiles")
+        client.create_table.assert_not_called()
+
+    def test_dynamo_add_oversized(self):
+        table = unittest.mock.Mock()
+        table.name = "test"
+        cache = converters.tools.DynamoCache(table, converters.tools.JsonSerializer())
+        cache.add("small", {"value": "x"})
+        with self.assertRaises(converters.tools.CacheError):
+            cache.add("big", {"value": "x" * converters.tools.DYNAMO_MAX_ITEM_SIZE})
+        table.put_item.assert_called_once()